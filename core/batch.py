@@ -0,0 +1,185 @@
+# The batch runner plays lots of games with no screen and no human, for testing
+# and balancing. Each game is seeded, so any game can be played again exactly,
+# and the player is a policy: a function that looks at the world and returns
+# the key it would press. Games are spread over a pool of processes, and the
+# results are written to a sink and added up as they come in, in whatever
+# order they finish.
+
+from core import world
+
+import csv
+import functools
+import json
+import multiprocessing
+
+
+# The keys that move the player and its target in each of the six directions,
+# in the order direction() numbers them.
+MOVE_KEYS = "kiuhnm"
+AIM_KEYS = "frescx"
+
+
+# Returns the direction (0-5) from pos that gets closest to goal, only looking
+# at the directions for which ok(tile) is true. Returns None if none are.
+def toward(pos, goal, ok=None):
+    best,best_d = None,None
+    for d in range(6):
+        step = world.direction(pos[0],pos[1],d)
+        if ok and not ok(step):
+            continue
+        dist = world.distance(step,goal)
+        if best is None or dist < best_d:
+            best,best_d = d,dist
+    return best
+
+# Presses random keys, like a cat on the keyboard. Policies roll their dice
+# with the world's own generator, so a game depends only on its seed.
+def random_policy(w):
+    return w.random.choice(MOVE_KEYS+AIM_KEYS+"z")
+
+# Walks towards the nearest bad guy that's still alive, and once it's in view,
+# puts the target on it and shoots. Now and then it takes a random step, so it
+# doesn't get stuck behind a wall forever.
+def hunter_policy(w):
+    p = w.player
+    me = p.x,p.y
+    foes = [e for e in w.entities if e is not p and e.hp > 0]
+    if not foes or w.random.random() < 0.1:
+        return w.random.choice(MOVE_KEYS)
+    foe = min(foes, key=lambda e: world.distance(me,(e.x,e.y)))
+    pos = foe.x,foe.y
+    
+    if w.can_see(p,pos):
+        if p.target == pos:
+            return "z"
+        return AIM_KEYS[toward(p.target or me,pos)]
+    d = toward(me,pos,lambda t: w.is_free(*t))
+    if d is None:
+        return w.random.choice(MOVE_KEYS)
+    return MOVE_KEYS[d]
+
+POLICIES = {"hunter": hunter_policy,
+            "random": random_policy}
+
+
+# Play one game from the given seed until the player dies, quits, or has
+# survived max_turns rounds, and return how it went. The policy only gets
+# asked for a key when the game is waiting on the player. With use_store, the
+# world keeps its entities in an EntityStore.
+def play(seed, policy="hunter", max_turns=1000, use_store=False):
+    choose = POLICIES[policy]
+    w = world.World(seed=seed, use_store=use_store)
+    while (w.running and w.player.hp > 0 and
+           w.stats["turns"] < max_turns):
+        keys = ()
+        if w.idle():
+            keys = (choose(w),)
+        w.step(keys)
+    
+    report = {"seed": seed, "policy": policy}
+    report.update(w.stats)
+    report["alive"] = w.player.hp > 0
+    return report
+
+
+# The fields of a game's report, in the order they are written out.
+FIELDS = ["seed","policy","turns","levels","shots","hits","alive"]
+
+
+# Sinks write out each game's report as it comes in. JsonSink writes one JSON
+# object per line, and CsvSink writes a header and then one row per game.
+class JsonSink(object):
+    def __init__(self, f):
+        self.f = f
+    
+    def write(self, report):
+        self.f.write(json.dumps(report, sort_keys=True)+"\n")
+        self.f.flush()
+
+class CsvSink(object):
+    def __init__(self, f):
+        self.f = f
+        self.writer = csv.DictWriter(f, FIELDS)
+        self.writer.writeheader()
+    
+    def write(self, report):
+        self.writer.writerow(report)
+        self.f.flush()
+
+# Returns a sink for the open file f, picking the format from its name.
+def sink_for(f, name=""):
+    if name.endswith(".csv"):
+        return CsvSink(f)
+    return JsonSink(f)
+
+
+# Totals keeps running statistics over the reports seen so far, without
+# keeping the reports: for each number, the count, mean, spread, and smallest
+# and largest values. The mean and spread are updated as in Welford's method,
+# so they stay accurate over any number of games.
+class Totals(object):
+    NUMBERS = ["turns","levels","shots","hits","alive"]
+    
+    def __init__(self):
+        self.games = 0
+        self.mean = dict((k,0.0) for k in self.NUMBERS)
+        self._m2 = dict((k,0.0) for k in self.NUMBERS)
+        self.low = {}
+        self.high = {}
+    
+    def add(self, report):
+        self.games += 1
+        for k in self.NUMBERS:
+            v = float(report[k])
+            delta = v - self.mean[k]
+            self.mean[k] += delta/self.games
+            self._m2[k] += delta*(v - self.mean[k])
+            self.low[k] = min(self.low.get(k,v),v)
+            self.high[k] = max(self.high.get(k,v),v)
+    
+    # Returns the standard deviation of one of the numbers.
+    def stdev(self, k):
+        if self.games < 2:
+            return 0.0
+        return (self._m2[k]/(self.games-1))**0.5
+    
+    # Returns the totals as lines of text.
+    def summary(self):
+        lines = ["%d games"%self.games]
+        if self.games:
+            for k in self.NUMBERS:
+                lines.append("%-7s mean %9.3f  sd %9.3f  min %6g  max %6g"%(
+                    k,self.mean[k],self.stdev(k),self.low[k],self.high[k]))
+        return lines
+
+
+# Play the games for each of 'seeds', on 'processes' processes (one per core
+# if None, or in this process if 1). Each report is written to 'sink', if
+# given, and passed to progress(report, totals) as it comes in. Games are
+# handed to the workers 'chunk' at a time. Returns the Totals.
+def run(seeds, policy="hunter", max_turns=1000, processes=None, sink=None,
+        progress=None, chunk=16, use_store=False):
+    job = functools.partial(play, policy=policy, max_turns=max_turns,
+                            use_store=use_store)
+    totals = Totals()
+    def take(report):
+        totals.add(report)
+        if sink: sink.write(report)
+        if progress: progress(report, totals)
+    
+    if processes == 1:
+        for seed in seeds:
+            take(job(seed))
+        return totals
+    
+    pool = multiprocessing.Pool(processes)
+    try:
+        for report in pool.imap_unordered(job, seeds, chunk):
+            take(report)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return totals
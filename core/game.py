@@ -7,15 +7,98 @@ from core import gfx
 from core import world
 
 import sys
+import time
 import traceback
 
 
+# The Scheduler runs the game loop. The simulation is stepped at a fixed rate
+# of tick_rate ticks per second, no matter how long drawing takes, and frames
+# are drawn at up to fps frames per second, sleeping only for whatever is left
+# of each frame. A frame is only drawn if a tick said something changed. If we
+# fall behind, we drop frames (and, after max_ticks, ticks) rather than slow
+# the game down. With an fps of 0 there is no timing at all: every pass does
+# one tick and never sleeps, which is what the headless mode wants. When the
+# game says it's idle, we block on wait() for up to idle_timeout seconds
+# instead of ticking away, and pick up from whenever we wake. Unthrottled, the
+# wait has no timeout, so if nothing can ever wake us, running() has to say
+# so.
+class Scheduler(object):
+    def __init__(self, fps=50, tick_rate=50, max_ticks=5, idle_timeout=0.25):
+        self.fps = fps
+        self.tick_rate = tick_rate
+        self.max_ticks = max_ticks
+        self.idle_timeout = idle_timeout
+        self.frames = 0
+        self.ticks = 0
+    
+    # Run until running() returns false, or after 'limit' ticks if given.
+    # tick() steps the game and returns true if anything changed, and draw()
+    # draws a frame. If given, idle() says whether the game is waiting on the
+    # player, and wait(timeout) blocks until they do something.
+    def run(self, tick, draw, running, idle=None, wait=None, limit=None):
+        if not self.fps:
+            dirty = True
+            while running() and (limit is None or self.ticks < limit):
+                if tick() or dirty:
+                    draw()
+                    self.frames += 1
+                    dirty = False
+                self.ticks += 1
+                if idle and wait and idle():
+                    wait(0)
+            return
+        
+        frame_time = 1.0 / self.fps
+        tick_time = 1.0 / self.tick_rate
+        last = next_frame = time.time()
+        lag = tick_time
+        dirty = True
+        while running() and (limit is None or self.ticks < limit):
+            now = time.time()
+            lag += now - last
+            last = now
+            
+            n = 0
+            while (lag >= tick_time and running() and
+                   (limit is None or self.ticks < limit)):
+                if tick(): dirty = True
+                lag -= tick_time
+                n += 1
+                self.ticks += 1
+                if n >= self.max_ticks:
+                    lag = 0
+                    break
+            
+            if dirty:
+                draw()
+                self.frames += 1
+                dirty = False
+            
+            if idle and wait and idle():
+                wait(self.idle_timeout)
+                last = next_frame = time.time()
+                lag = tick_time
+                continue
+            
+            next_frame += frame_time
+            delay = next_frame - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                next_frame = time.time()
+
+
 # A Game represents a single instance of a game, including its maps,
 # data, and everything else.
 class Game(object):
-    def __init__(self, sdl):
-        self.world = world.World()
+    def __init__(self, sdl, fps=50, tick_rate=50, seed=None):
+        self.world = world.World(seed=seed)
         self.sdl = sdl
+        self.fps = fps
+        self.tick_rate = tick_rate
+        self.started = False
+        self.shown = None
+        self.generation = None
     
     
     def display_title(self):
@@ -36,35 +119,77 @@ class Game(object):
             x = 40-len(t)//2
             q = y==1
             
-            for c in t:
-                gfx.draw(x,y,c,'g'+("!" if q else ""))
-                x+= 1
+            gfx.draw_text(x,y,t,'g'+("!" if q else ""))
+    
+    # Step the game by one tick. Until the player presses Enter, we are on the
+    # title screen, and any keys after the Enter are kept for the world.
+    # Returns true if there is something new to draw, which is also the case
+    # if the screen has been wiped since the last frame.
+    def tick(self):
+        keys = gfx.get_inputs()
+        lost = gfx.generation() != self.generation
+        if not self.started:
+            for i,k in enumerate(keys):
+                if k == "q":
+                    self.world.running = False
+                    break
+                if k == "enter":
+                    self.started = True
+                    self.world.inputs.extend(keys[i+1:])
+                    break
+            return self.started or lost
+        return self.world.step(keys) or lost
+    
+    # Returns true if nothing is going to happen until a key is pressed.
+    def idle(self):
+        return not self.started or self.world.idle()
+    
+    # Returns true until the world stops, or until it is waiting on a key that
+    # is never going to come, like when a headless script has run out.
+    def running(self):
+        return self.world.running and not (self.idle() and gfx.exhausted())
+    
+    # Draw whatever we're looking at.
+    def draw(self):
+        if not self.started:
+            self.display_title()
+        else:
+            # The world only draws what changed, so coming from the title
+            # screen, or after the screen got wiped, it has to start from a
+            # blank screen.
+            if self.shown != "world" or gfx.generation() != self.generation:
+                gfx.clear()
+                self.world.screen.invalidate()
+            self.world.draw()
+            self.world.draw_gui()
+            self.world.screen.flush()
+            self.world.changed = False
+        self.shown = "world" if self.started else "title"
+        self.generation = gfx.generation()
+        gfx.refresh()
     
     # Runs an interactive session of our game with the player until either
     # the player stops playing or an error occurs. Here, we pass input to the
     # world until we are told we don't need to anymore. If an error occurs, we
-    # turn off graphics, print the traceback, and kill the program.
-    def play(self):
+    # turn off graphics, print the traceback, and kill the program. Normally
+    # we try SDL and curses, but you can ask for a particular graphics mode,
+    # such as "headless". The game also ends once the keys fed to the headless
+    # mode have run out and it's waiting on another. If 'limit' is given, the
+    # game ends after that many ticks no matter what.
+    def play(self, mode=None, limit=None):
         first, second = "sdl","ascii"
         if not self.sdl: first,second = "ascii","sdl"
+        if mode: first = second = mode
         try: 
             gfx.start(first)
         except:
             gfx.start(second)
         
         try:
-            c = -1
-            while c != "enter":
-                self.display_title()
-                c = gfx.get_input()
-                gfx.refresh()
-        
-            while self.world.running:
-                c = gfx.get_input()
-                self.world.handle(c)
-                self.world.draw()
-                self.world.draw_gui()
-                gfx.refresh()
+            fps = 0 if gfx.mode() == "headless" else self.fps
+            scheduler = Scheduler(fps, self.tick_rate)
+            scheduler.run(self.tick, self.draw, self.running,
+                          self.idle, gfx.wait, limit)
         except:
             gfx.stop()  
             print(traceback.format_exc())
@@ -1,7 +1,10 @@
-# The GFX module is a wrapper around both gfx_ascii and gfx_sdl (and conceivably
-# more experimental gfx libraries). It provides an interface to the underlying
-# grid-based drawing system where the game doesn't need to think about primitive
-# drawing functions.
+# The GFX module is a wrapper around gfx_ascii, gfx_sdl and gfx_headless (and
+# conceivably more experimental gfx libraries). It provides an interface to the
+# underlying grid-based drawing system where the game doesn't need to think
+# about primitive drawing functions.
+
+
+from collections import OrderedDict, deque
 
 
 # Try to import ASCII
@@ -20,22 +23,49 @@ try:
 except: pass
 
 
+# The headless mode has no requirements, but import it the same way.
+headless_available = False
+try:
+    from core import gfx_headless
+    headless_available = True
+except: pass
+
+
 # API:
 #   start()
 #   stop()
 #   mode()
+#   generation()
 #   get_input()
+#   get_inputs()
+#   wait(timeout)
+#   exhausted()
 #   refresh()
 #   clear()
+#   style(col)
+#   prewarm(styles)
 #   draw(x,y,c,col)
+#   draw_text(x,y,s,col)
+#   draw_span(x,y,cells)
 gfx = None
 old_mode = "None"
 
+# Keys that have been taken from the graphics mode but not handed out yet.
+_queue = deque()
+
+# Color strings like "r!" get compiled by the graphics mode into a style handle
+# that it can draw with directly, and are remembered here so that each string
+# only gets compiled once. The handles only make sense to the mode that made
+# them, so this gets emptied whenever the mode changes.
+_styles = {}
+
 
 # Start graphics. This either draws a window or sets a terminal screen. Once
 # the graphics have been started, future calls to start will use the old mode.
 def start(mode=None):
-    global gfx, old_mode, ascii_available, sdl_available
+    global gfx, old_mode, ascii_available, sdl_available, headless_available
+    _styles.clear()
+    _queue.clear()
     
     if mode is None:
         mode = old_mode
@@ -45,6 +75,7 @@ def start(mode=None):
     
     if mode == "ascii" and ascii_available: gfx = gfx_ascii
     elif mode == "sdl" and sdl_available: gfx = gfx_sdl
+    elif mode == "headless" and headless_available: gfx = gfx_headless
     old_mode = mode
 
     if gfx:
@@ -56,6 +87,7 @@ def start(mode=None):
 # Stop graphics. This turns off the display associated with the graphics mode.
 def stop():
     global gfx
+    _styles.clear()
     if gfx:
         report = gfx.stop()
         gfx = None
@@ -68,9 +100,48 @@ def mode():
     else: return "None"
 
 
+# Returns a number that changes whenever what was on the screen has been lost,
+# like when the terminal is resized or the graphics mode changes. Anything that
+# only draws what changed has to draw everything again when it does.
+def generation():
+    global gfx
+    if gfx: return (old_mode, gfx.generation)
+    return None
+
+
+# Move every key the graphics mode has waiting into our queue.
+def poll():
+    global gfx
+    if gfx: _queue.extend(gfx.get_inputs())
+
+
+# Returns the next key the user pressed, or None if there isn't one.
 def get_input():
+    poll()
+    if _queue: return _queue.popleft()
+
+
+# Returns all of the keys the user has pressed that haven't been handed out
+# yet, in order.
+def get_inputs():
+    poll()
+    report = list(_queue)
+    _queue.clear()
+    return report
+
+
+# Block until the user presses something or 'timeout' seconds pass. Returns
+# right away if there are already keys waiting.
+def wait(timeout):
     global gfx
-    if gfx: return gfx.get_input()
+    if gfx and not _queue: gfx.wait(timeout)
+
+
+# Returns true if there will never be another key, like when the keys fed to
+# the headless mode have all been handed out. A real keyboard never runs out.
+def exhausted():
+    global gfx
+    return bool(gfx) and not _queue and gfx.exhausted()
 
 
 
@@ -84,8 +155,150 @@ def clear():
     if gfx: return gfx.clear()
 
 
+# Returns the style handle for a color string. Lowercase letters are
+# foreground, uppercase are background. Use an ! for bold and ? for reverse.
+def style(col=""):
+    global gfx
+    handle = _styles.get(col)
+    if handle is None and gfx:
+        handle = gfx.style(col)
+        _styles[col] = handle
+    return handle
+
+
+# Get the graphics mode ready to draw the given styles (color strings or
+# handles). Only modes that have something to prepare need to do anything.
+def prewarm(styles):
+    global gfx
+    if gfx and hasattr(gfx,"prewarm"): return gfx.prewarm(styles)
+
+
+# Draw a character at X,Y. 'col' can be a color string or a style handle.
 def draw(x,y,c,col=""):
     global gfx
-    if gfx: return gfx.draw(x,y,c,col)
+    if gfx:
+        if isinstance(col,str):
+            handle = _styles.get(col)
+            if handle is None: handle = style(col)
+            col = handle
+        return gfx.draw(x,y,c,col)
+
+
+# Draw the string s starting at X,Y, all in one style. This is one call no
+# matter how long the string is.
+def draw_text(x,y,s,col=""):
+    global gfx
+    if gfx:
+        if isinstance(col,str):
+            handle = _styles.get(col)
+            if handle is None: handle = style(col)
+            col = handle
+        return gfx.draw_text(x,y,s,col)
+
+
+# Draw a run of cells starting at X,Y. 'cells' is a list of (character, style)
+# pairs, where the styles can be color strings or handles.
+def draw_span(x,y,cells):
+    global gfx
+    if gfx:
+        report = []
+        for (c,col) in cells:
+            if isinstance(col,str):
+                handle = _styles.get(col)
+                if handle is None: handle = style(col)
+                col = handle
+            report.append((c,col))
+        return gfx.draw_span(x,y,report)
 
 
+# A Layer is one sheet of a Compositor's screen: a set of cells, each a
+# (character, color) pair, and the key it was last built from. The key can be
+# anything that describes everything the layer depends on. Call stale with the
+# current key; if it changed, the layer is emptied and you should draw it
+# again, otherwise it keeps what it had and you don't have to do anything.
+class Layer(object):
+    def __init__(self, name):
+        self.name = name
+        self.cells = {}
+        self.key = None
+        self.dirty = False
+        self.old = None
+    
+    def stale(self, key):
+        if key == self.key:
+            return False
+        self.key = key
+        if not self.dirty:
+            self.old = self.cells
+            self.dirty = True
+        self.cells = {}
+        return True
+    
+    def draw(self, x, y, c, col=""):
+        self.cells[(x,y)] = (c,col)
+    
+    def draw_text(self, x, y, s, col=""):
+        for c in s:
+            self.cells[(x,y)] = (c,col)
+            x += 1
+
+
+# The Compositor keeps the screen as a stack of named layers, bottom first. On
+# flush, only the cells that belong to layers that were rebuilt get worked out
+# again, and only the ones that came out different get drawn. Nothing is
+# cleared between frames, so if something else draws over the screen, call
+# invalidate to have everything drawn again.
+class Compositor(object):
+    def __init__(self, names):
+        self.layers = OrderedDict((n,Layer(n)) for n in names)
+        self._shown = {}
+    
+    def layer(self, name):
+        return self.layers[name]
+    
+    def invalidate(self):
+        self._shown = {}
+        for layer in self.layers.values():
+            layer.key = None
+    
+    # Draw whatever changed. Returns true if anything did. Changed cells that
+    # sit next to each other in a row go out as one span.
+    def flush(self):
+        touched = set()
+        for layer in self.layers.values():
+            if layer.dirty:
+                touched.update(layer.old)
+                touched.update(layer.cells)
+                layer.dirty = False
+                layer.old = None
+        if not touched:
+            return False
+        
+        order = list(self.layers.values())
+        order.reverse()
+        changed = []
+        for pos in touched:
+            cell = None
+            for layer in order:
+                cell = layer.cells.get(pos)
+                if cell: break
+            if cell != self._shown.get(pos):
+                if cell:
+                    self._shown[pos] = cell
+                else:
+                    cell = (" ","")
+                    del self._shown[pos]
+                changed.append((pos[1],pos[0],cell))
+        
+        changed.sort()
+        run = []
+        for (y,x,cell) in changed:
+            if run and (y != ry or x != rx+len(run)):
+                draw_span(rx,ry,run)
+                run = []
+            if not run:
+                rx,ry = x,y
+            run.append(cell)
+        if run:
+            draw_span(rx,ry,run)
+        return True
@@ -5,6 +5,8 @@
 # module will fail, so you need to catch that when you import it.
 
 import curses
+import select
+import sys
 
 
 # API:
@@ -12,8 +14,14 @@ import curses
 #   stop()
 #   mode()
 #   get_input()
+#   get_inputs()
+#   wait(timeout)
+#   exhausted()
 #   clear()
+#   style(col)
 #   draw(x,y,c,col)
+#   draw_text(x,y,s,col)
+#   draw_span(x,y,cells)
 
 
 # The "screen" used by Curses. When "None", curses is off, and all curses
@@ -21,6 +29,20 @@ import curses
 # mode.
 _screen = None
 
+# Drawing doesn't go straight to curses. Instead, each frame is drawn into the
+# back buffer, a grid of (character, attribute) pairs, and the front buffer
+# remembers what the terminal is showing. On refresh, only the cells that are
+# different get sent to the terminal. The size of the terminal is kept in _size
+# as (h,w) so that we don't have to ask curses on every draw.
+_size = 0,0
+_front = []
+_back = []
+_blank = (" ",0)
+
+# Goes up by one every time whatever was on the terminal is lost, so that
+# anyone drawing only what changed knows to draw everything again.
+generation = 0
+
 
 # This function turns on everything required by Curses. It puts the terminal in
 # raw mode, turns of echoing, scrolling, etc. It also initializes the colors.
@@ -43,6 +65,19 @@ def start():
             for b in range(8):
                 curses.init_pair(i, b, a)
                 i += 1
+        _resize()
+
+# Start over with empty buffers that fit the terminal. This is called when the
+# terminal changes size, since we can no longer trust what's on it.
+def _resize():
+    global _size, _front, _back, generation
+    if _screen:
+        generation += 1
+        _screen.erase()
+        _size = _screen.getmaxyx()
+        h,w = _size
+        _front = [[_blank]*w for y in range(h)]
+        _back = [[_blank]*w for y in range(h)]
 
 # This turns off curses and makes it safe to kill the program. You can call
 # stop more than once safely. You should also be able to call start again after
@@ -101,25 +136,82 @@ def get_input():
     if _screen:
         c = _screen.getch()
         #curses.flushinp()
-        if c == 27: return "escape"
-        elif c == 10 or c == 13: return "enter"
-        elif c > 0 and c < 256: return "%c"%c
-        elif c in _keymap: return _keymap[c]
+        return _translate(c)
     return None
 
+def _translate(c):
+    if c == curses.KEY_RESIZE: _resize()
+    if c == 27: return "escape"
+    elif c == 10 or c == 13: return "enter"
+    elif c > 0 and c < 256: return "%c"%c
+    elif c in _keymap: return _keymap[c]
+    return None
+
+# Returns every key the user has pressed since the last time we asked, in
+# order, so that nothing gets lost when they type faster than we draw.
+def get_inputs():
+    global _screen
+    report = []
+    if _screen:
+        c = _screen.getch()
+        while c != -1:
+            k = _translate(c)
+            if k is not None: report.append(k)
+            c = _screen.getch()
+    return report
+
+# Block until the user presses something or 'timeout' seconds pass, without
+# spinning. The keys themselves are left for get_inputs.
+def wait(timeout):
+    if _screen:
+        try:
+            select.select([sys.stdin],[],[],timeout)
+        except (select.error, ValueError):
+            pass
+
+# Someone can always press another key.
+def exhausted():
+    return False
 
-# In curses, refresh just controls the framerate.
+
+# Send whatever changed since the last frame to the terminal. Changed cells
+# that sit next to each other and share attributes are written with a single
+# addstr. The game loop takes care of the framerate.
 def refresh():
+    global _front
     if _screen:
-        curses.napms(20)
+        h,w = _size
+        for y in range(h):
+            back = _back[y]
+            front = _front[y]
+            if back == front:
+                continue
+            x = 0
+            while x < w:
+                if back[x] == front[x]:
+                    x += 1
+                    continue
+                start = x
+                attr = back[x][1]
+                x += 1
+                while x < w and back[x] != front[x] and back[x][1] == attr:
+                    x += 1
+                text = "".join(c for (c,a) in back[start:x])
+                try:
+                    _screen.addstr(y,start,text,attr)
+                except curses.error:
+                    pass
+            _front[y] = list(back)
+        _screen.refresh()
 
 
-# Clear the screen. This uses Curses' optimized erase routine, so it's not
-# necessarily inefficient.
+# Clear the screen. This only empties the back buffer; anything that gets
+# drawn again before the next refresh won't be sent to the terminal at all.
 def clear():
-    global _screen
+    global _back
     if _screen:
-        _screen.erase()
+        h,w = _size
+        _back = [[_blank]*w for y in range(h)]
 
 # This function returns the curses color pair for the provided color
 # represented as a pair of characters. This is a private function.
@@ -145,25 +237,52 @@ def _color(fg="w", bg="b"):
         return curses.color_pair(0)
     return curses.color_pair(1 + j*8 + i)
 
-# Draw a character at X,Y. Includes boundary checking. You can also
-# include color codes. Lowercase letters are foreground, uppercase are
-# background. Use an ! for bold and ? for reverse
+# Compile a color string into a style handle, which for curses is just the
+# attribute to draw with. Lowercase letters are foreground, uppercase are
+# background. Use an ! for bold and ? for reverse.
+def style(col=""):
+    mod = 0
+    if "!" in col: mod |= curses.A_BOLD
+    if "?" in col: mod |= curses.A_REVERSE
+    if curses.has_colors():
+        fg = "w"
+        bg = "x"
+        for q in "xrgybmcw":
+            if q in col: fg = q
+        for q in "XRGYBMCW":
+            if q in col: bg = q
+        mod |= _color(fg,bg)
+    return mod
+
+# Draw a character at X,Y. Includes boundary checking. 'col' is a style handle
+# from style, or a color string that gets compiled on the spot.
 def draw(x,y,c,col=""):
     global _screen
     if _screen:
-        h,w = _screen.getmaxyx()
+        h,w = _size
         if x >= 0 and x < w and y >= 0 and y < h and (x,y)!=(w-1,h-1):
-            mod = 0
-            if "!" in col: mod |= curses.A_BOLD
-            if "?" in col: mod |= curses.A_REVERSE
-            if curses.has_colors():
-                fg = "w"
-                bg = "x"
-                for q in "xrgybmcw":
-                    if q in col: fg = q
-                for q in "XRGYBMCW":
-                    if q in col: bg = q
-                mod |= _color(fg,bg)
-            
-            _screen.addch(y,x,c,mod)
+            if isinstance(col,str): col = style(col)
+            _back[y][x] = (c,col)
 
+# Draw the string s starting at X,Y, all in one style. The string is clipped
+# to the screen once, rather than checking every character.
+def draw_text(x,y,s,col=""):
+    if _screen:
+        if isinstance(col,str): col = style(col)
+        draw_span(x,y,[(c,col) for c in s])
+
+# Draw a run of (character, style) cells starting at X,Y. Styles can be handles
+# or color strings.
+def draw_span(x,y,cells):
+    if _screen:
+        h,w = _size
+        if y < 0 or y >= h:
+            return
+        end = min(x+len(cells), w-1 if y == h-1 else w)
+        start = max(x,0)
+        if start >= end:
+            return
+        cells = cells[start-x:end-x]
+        row = _back[y]
+        row[start:end] = [(c,style(col) if isinstance(col,str) else col)
+                          for (c,col) in cells]
@@ -0,0 +1,141 @@
+# The headless GFX module pretends to be a screen without needing a terminal or
+# a window. Everything is drawn into a grid of cells in memory, input comes from
+# a queue of keys that you feed it ahead of time, and refresh doesn't wait
+# around, so the game runs as fast as it can. This is useful for testing and
+# benchmarking the real drawing code, or for running the game on a server.
+
+from collections import deque
+
+
+# API:
+#   start()
+#   stop()
+#   mode()
+#   get_input()
+#   get_inputs()
+#   wait(timeout)
+#   exhausted()
+#   refresh()
+#   clear()
+#   style(col)
+#   draw(x,y,c,col)
+#   draw_text(x,y,s,col)
+#   draw_span(x,y,cells)
+#   feed(keys)
+#   capture(flag)
+#   screen()
+
+
+# The grid of (character, style) cells, and its size. When _cells is None the
+# headless screen is off and everything silently does nothing, like the other
+# modes.
+_cells = None
+_sw, _sh = 0,0
+_blank = (" ","")
+
+# Goes up by one every time the screen is started, since it starts out blank.
+generation = 0
+
+# Keys waiting to be returned by get_input, the number of frames refreshed so
+# far, and the text of each frame if we're capturing them.
+_keys = deque()
+frames = 0
+captured = None
+
+
+# Start the headless screen with the given size in cells.
+def start(screen_w=80, screen_h=24):
+    global _cells, _sw, _sh, frames, generation
+    if _cells is None:
+        generation += 1
+        _sw, _sh = screen_w, screen_h
+        _cells = [[_blank]*_sw for y in range(_sh)]
+        frames = 0
+
+# Stop the headless screen. Keys that haven't been read yet are thrown away.
+def stop():
+    global _cells
+    if _cells is not None:
+        _cells = None
+        _keys.clear()
+
+# Return the gfx mode.
+def mode():
+    return "headless"
+
+# Add keys to the end of the input queue. 'keys' is a list of key names, the
+# same strings get_input would return, like "k" or "enter".
+def feed(keys):
+    _keys.extend(keys)
+
+# Returns the next key in the queue, or None if there aren't any.
+def get_input():
+    if _cells is not None and _keys:
+        return _keys.popleft()
+    return None
+
+# Returns every key in the queue, in order, emptying it.
+def get_inputs():
+    report = []
+    if _cells is not None:
+        report.extend(_keys)
+        _keys.clear()
+    return report
+
+# Nobody is going to press anything, so there's nothing to wait for.
+def wait(timeout):
+    pass
+
+# Returns true if every key that was fed in has been read, so no more are
+# coming unless someone feeds some.
+def exhausted():
+    return _cells is not None and not _keys
+
+# Start (or stop) keeping the text of every frame in the 'captured' list.
+def capture(flag=True):
+    global captured
+    captured = [] if flag else None
+
+# Returns what is on the screen as text, one line per row.
+def screen():
+    if _cells is None:
+        return ""
+    return "\n".join("".join(c for (c,col) in row) for row in _cells)
+
+# Count the frame, and remember it if we're capturing. There is no framerate
+# to keep to, so this never waits.
+def refresh():
+    global frames
+    if _cells is not None:
+        frames += 1
+        if captured is not None:
+            captured.append(screen())
+
+# Clear the screen.
+def clear():
+    global _cells
+    if _cells is not None:
+        _cells = [[_blank]*_sw for y in range(_sh)]
+
+# There's nothing to compile color strings into, so the handle is the string.
+def style(col=""):
+    return col
+
+# Draw a character at X,Y. Includes boundary checking.
+def draw(x,y,c,col=""):
+    if _cells is not None:
+        if x >= 0 and x < _sw and y >= 0 and y < _sh:
+            _cells[y][x] = (c,col)
+
+# Draw the string s starting at X,Y, all in one style.
+def draw_text(x,y,s,col=""):
+    draw_span(x,y,[(c,col) for c in s])
+
+# Draw a run of (character, style) cells starting at X,Y, clipped to the
+# screen.
+def draw_span(x,y,cells):
+    if _cells is not None and y >= 0 and y < _sh:
+        start = max(x,0)
+        end = min(x+len(cells),_sw)
+        if start < end:
+            _cells[y][start:end] = cells[start-x:end-x]
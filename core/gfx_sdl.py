@@ -8,28 +8,43 @@ if pygame.font is None:
 
 from core import log
 
+from collections import OrderedDict, deque
+
 
 # API:
 #   start()
 #   stop()
 #   mode()
 #   get_input()
+#   get_inputs()
+#   wait(timeout)
+#   exhausted()
 #   clear()
+#   style(col)
+#   prewarm(styles)
 #   draw(x,y,c,col)
+#   draw_text(x,y,s,col)
+#   draw_span(x,y,cells)
 
 
 # The "screen" used by Pygame. These private variables serve to do some of the
-# optimization of Curses. The 'fakescreen' keeps track of cells that have not
-# changed, and the dirty list shows all of the rectangles that should be
-# updated on the screen.
+# optimization of Curses. Each frame is drawn into the back buffer, a grid of
+# (character, style) cells, and the front buffer remembers what is on the
+# window. On refresh, only the cells that differ are blitted and updated.
 _screen = None
-_changes = {}
+_front = []
+_back = []
+_blank = (" ",("w","x",False))
 _sw, _sh, _tw, _th = 0,0,0,0
 
+# Goes up by one every time the window is made, since it starts out blank.
+generation = 0
+
 
-# The Start function creates a 24x80 tile surface attached to the window and
-# programmatically generates a font tile for each color and boldness.
-_tiles = None
+# The Start function creates a 24x80 tile surface attached to the window. Font
+# tiles are rendered the first time each (character, style) gets drawn, and are
+# kept in slots of a single atlas surface. When the atlas is full, the tile that
+# was used least recently gives up its slot.
 _colors = { "x": (0,0,0),
             "r": (200,0,0),
             "g": (0,200,0),
@@ -39,49 +54,80 @@ _colors = { "x": (0,0,0),
             "c": (0,200,200),
             "w": (200,200,200),
     }
-def start( screen_w=80, screen_h=24, tile_w=15, tile_h=30):
-    global _screen, _tiles, _colors, _fakescreen, _dirty
-    global _sw, _sh, _tw, _th
+_font = None
+_atlas = None
+_atlas_w = 32
+_glyphs = OrderedDict()
+_free = []
+def start( screen_w=80, screen_h=24, tile_w=15, tile_h=30, atlas_slots=1024):
+    global _screen, _font, _atlas, _glyphs, _free, _front, _back
+    global _sw, _sh, _tw, _th, generation
     if not _screen:
+        generation += 1
         pygame.init()
         pygame.key.set_repeat(500,100)
         _sw, _sh, _tw, _th = screen_w, screen_h, tile_w, tile_h
         _screen = pygame.display.set_mode((_sw*_tw, _sh*_th))
         _screen.fill((0,0,0))
-        _changes = {}
+        _front = [[_blank]*_sw for y in range(_sh)]
+        _back = [[_blank]*_sw for y in range(_sh)]
         
-        if _tiles is None:
-            f = pygame.font.Font(None,_th-2)
-            _tiles = {}
-            for c in (" abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ"+
-                      "1234567890-=\\[];',./`~!@#$%^&*()_+|{}:\"<>?"):
-             for fg in "xrgybmcw":
-              for bg in "xrgybmcw":
-               for bold in [False,True]:
-                f.set_bold(bold)
-                fg_col = _colors[fg]
-                bg_col = _colors[bg]
-                if bold:
-                    fg_col = fg_col[0]+50,fg_col[1]+50,fg_col[2]+50
-                
-                # Here we render the character and align it to our grid.
-                s1 = f.render(c,True,fg_col,bg_col).convert()
-                w,h = s1.get_size()
-                w = min(w,_tw-2)
-                s1 = pygame.transform.smoothscale(s1.convert(),(w,_th-2))
-                s2 = pygame.Surface((_tw,_th))
-                s2.fill(bg_col)
-                s2.blit(s1, (_tw//2-(w//2),1) )
-                
-                # Store the surface in the tiles dictionary.
-                _tiles[(c,fg,bg,bold)] = s2.convert()
+        _font = pygame.font.Font(None,_th-2)
+        rows = (atlas_slots+_atlas_w-1)//_atlas_w
+        _atlas = pygame.Surface((_atlas_w*_tw, rows*_th)).convert()
+        _glyphs = OrderedDict()
+        _free = list(range(atlas_slots-1,-1,-1))
+
+# Returns the area of the atlas holding the tile for character c in the
+# style (fg,bg,bold), rendering it first if we don't have it.
+def _glyph(c,fg,bg,bold):
+    key = (c,fg,bg,bold)
+    area = _glyphs.get(key)
+    if area is not None:
+        _glyphs.move_to_end(key)
+        return area
+    if _free:
+        i = _free.pop()
+        area = pygame.Rect((i%_atlas_w)*_tw,(i//_atlas_w)*_th,_tw,_th)
+    else:
+        old,area = _glyphs.popitem(last=False)
+    
+    _font.set_bold(bold)
+    fg_col = _colors[fg]
+    bg_col = _colors[bg]
+    if bold:
+        fg_col = fg_col[0]+50,fg_col[1]+50,fg_col[2]+50
+    
+    # Here we render the character and align it to our grid.
+    s1 = _font.render(c,True,fg_col,bg_col).convert()
+    w,h = s1.get_size()
+    w = min(w,_tw-2)
+    s1 = pygame.transform.smoothscale(s1,(w,_th-2))
+    _atlas.fill(bg_col,area)
+    _atlas.blit(s1, (area.x+_tw//2-(w//2),area.y+1) )
+    
+    _glyphs[key] = area
+    return area
+
+# Render the tiles for a set of styles ahead of time, so that the first frame
+# that uses them doesn't have to. 'styles' can be color strings or handles.
+_chars = (" abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ"+
+          "1234567890-=\\[];',./`~!@#$%^&*()_+|{}:\"<>?")
+def prewarm(styles, chars=_chars):
+    if _screen:
+        for col in styles:
+            if isinstance(col,str): col = style(col)
+            for c in chars:
+                _glyph(c,*col)
 
 # This turns off Pygame.
 def stop():
-    global _screen
+    global _screen, _font, _atlas
     if _screen:
         pygame.quit()
         _screen = None
+        _font = None
+        _atlas = None
 
 # Return the gfx mode. This mode is sdl, as opposed to curses.
 def mode():
@@ -90,7 +136,8 @@ def mode():
 # Gets input from the user and translates it into python strings.
 # Returns None if the user hasn't pressed anything. Ideally this would
 # be intercepted by a keymapper object that doesn't rely on any literal
-# key definitions. We only handle the first event in the events queue.
+# key definitions. Keys that are pulled out of Pygame's event queue but not
+# returned yet wait in _pending.
 _keymap ={pygame.K_BACKSPACE: "backspace",
           pygame.K_UP:        "up",
           pygame.K_DOWN:      "down",
@@ -118,68 +165,121 @@ _keymap ={pygame.K_BACKSPACE: "backspace",
           pygame.K_PAGEDOWN:  "page_down",
           pygame.K_ESCAPE:    "escape",
           -1:                 None}
+_pending = deque()
 def get_input():
-    global _screen, _keymap
+    global _screen
     if _screen:
-        events = pygame.event.get(pygame.KEYDOWN)
-        quit = pygame.event.get(pygame.QUIT)
-        others = pygame.event.get()
-        
-        if len(quit) > 0: return "escape"
-        elif len(events) == 0: return None
-        elif events[0].key in _keymap: return _keymap[events[0].key]
-        else:
-            try:
-                return "%s"%events[0].unicode
-            except:
-                pass
-    
+        if not _pending: _pending.extend(get_inputs())
+        if _pending: return _pending.popleft()
     return None
 
-# This redraws the screen and handles the framerate. Should be called once
-# per game tick.
+# Returns every key the user has pressed since the last time we asked, in
+# order. Closing the window counts as pressing escape.
+def get_inputs():
+    global _screen, _keymap
+    report = []
+    if _screen:
+        report.extend(_pending)
+        _pending.clear()
+        for e in pygame.event.get():
+            if e.type == pygame.QUIT: report.append("escape")
+            elif e.type != pygame.KEYDOWN: continue
+            elif e.key in _keymap: report.append(_keymap[e.key])
+            else:
+                try:
+                    if e.unicode: report.append("%s"%e.unicode)
+                except:
+                    pass
+    return report
+
+# Block until something happens or 'timeout' seconds pass, without spinning.
+# The event is put back for get_inputs.
+def wait(timeout):
+    if _screen:
+        e = pygame.event.wait(int(timeout*1000))
+        if e.type != pygame.NOEVENT:
+            pygame.event.post(e)
+
+# Someone can always press another key.
+def exhausted():
+    return False
+
+# This redraws the screen. Should be called once per frame; the game loop
+# takes care of the framerate. Only cells whose contents changed since the last
+# frame get blitted, and each run of changed cells in a row becomes one dirty
+# rect.
 def refresh():
-    global _screen, _changes, _tw, _th
+    global _screen, _front, _tw, _th
     if _screen:
-        pygame.time.wait(20)
         dirty = []
-        
-        cleared = False
-        if "cleared" in _changes:
-            cleared = _changes.pop("cleared")
-        for x,y in _changes:
-            c,col = _changes[(x,y)]
-            target = pygame.Rect(x*_tw,y*_th,_tw,_th)
-            bold = "!" in col
-            fg = "w"
-            bg = "x"
-            for q in "xrgybmcw":
-                if q in col: fg = q
-            for q in "XRGYBMCW":
-                if q in col: bg = q
-            if "?" in col:
-                fg,bg=bg,fg
-            _screen.blit(_tiles[(c,fg,bg,bold)],target)
-            dirty.append(target)
-        if cleared:
-            pygame.display.update()
-        elif len(dirty) > 0:
+        for y in range(_sh):
+            back = _back[y]
+            front = _front[y]
+            if back == front:
+                continue
+            x = 0
+            while x < _sw:
+                if back[x] == front[x]:
+                    x += 1
+                    continue
+                start = x
+                blits = []
+                while x < _sw and back[x] != front[x]:
+                    c,(fg,bg,bold) = back[x]
+                    blits.append((_atlas,(x*_tw,y*_th),_glyph(c,fg,bg,bold)))
+                    x += 1
+                _screen.blits(blits,False)
+                dirty.append(pygame.Rect(start*_tw,y*_th,(x-start)*_tw,_th))
+            _front[y] = list(back)
+        if len(dirty) > 0:
             pygame.display.update(dirty)
-        _changes = {}
 
-# Clear the screen.
+# Clear the screen. Nothing is erased until the next refresh, and then only
+# the cells that didn't get drawn again.
 def clear():
-    global _screen, _changes
+    global _screen, _back
     if _screen:
-        _screen.fill((0,0,0))
-        _changes = {"cleared": True}
+        _back = [[_blank]*_sw for y in range(_sh)]
+
+# Compile a color string into a style handle, which for SDL is the
+# (fg,bg,bold) part of the key into _tiles. Lowercase letters are foreground,
+# uppercase are background. Use an ! for bold and ? for reverse.
+def style(col=""):
+    bold = "!" in col
+    fg = "w"
+    bg = "x"
+    for q in "xrgybmcw":
+        if q in col: fg = q
+    for q in "XRGYBMCW":
+        if q in col: bg = q
+    if "?" in col:
+        fg,bg=bg,fg
+    return (fg,bg,bold)
 
-# Draw a character at X,Y. Includes boundary checking. You can also
-# include color codes. Lowercase letters are foreground, uppercase are
-# background. Use an ! for bold and ? for reverse
+# Draw a character at X,Y. 'col' is a style handle from style, or a color
+# string that gets compiled on the spot.
 def draw(x,y,c,col=""):
-    global _screen, _changes
+    global _screen
+    if _screen:
+        if x >= 0 and x < _sw and y >= 0 and y < _sh:
+            if isinstance(col,str): col = style(col)
+            _back[y][x] = (c,col)
+
+
+# Draw the string s starting at X,Y, all in one style. The string is clipped
+# to the screen once, rather than checking every character.
+def draw_text(x,y,s,col=""):
     if _screen:
-        if _changes.get((x,y)) != (c,col):
-            _changes[(x,y)] = (c,col)
+        if isinstance(col,str): col = style(col)
+        draw_span(x,y,[(c,col) for c in s])
 
+# Draw a run of (character, style) cells starting at X,Y. Styles can be handles
+# or color strings.
+def draw_span(x,y,cells):
+    if _screen and y >= 0 and y < _sh:
+        start = max(x,0)
+        end = min(x+len(cells),_sw)
+        if start < end:
+            _back[y][start:end] = [(c,style(col) if isinstance(col,str)
+                                      else col)
+                                   for (c,col) in cells[start-x:end-x]]
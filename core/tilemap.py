@@ -0,0 +1,64 @@
+# The TileMap holds the terrain of a World. Tiles are stored as one byte each in
+# a flat bytearray, row by row, alongside two more bytearrays that say which
+# tiles block vision and which can be walked on. These "planes" are kept up to
+# date whenever a tile changes, so asking about a tile is a single index rather
+# than a string comparison. Indexing a TileMap by row gives back that row as a
+# string, so code that reads map[y][x] keeps working.
+
+
+# The tiles that block vision and the tiles that can't be walked through. Any
+# other character is open ground.
+OPAQUE = "#"
+SOLID = "#"
+
+
+class TileMap(object):
+    def __init__(self, w, h, fill="."):
+        self.w = w
+        self.h = h
+        self.cells = bytearray(fill.encode("ascii")*(w*h))
+        self.opaque = bytearray([1 if fill in OPAQUE else 0]*(w*h))
+        self.passable = bytearray([0 if fill in SOLID else 1]*(w*h))
+        self._rows = [None]*h
+
+    # Returns row y as a string. Rows are built when they're first asked for
+    # and kept until something in them changes.
+    def __getitem__(self, y):
+        row = self._rows[y]
+        if row is None:
+            row = self.cells[y*self.w:(y+1)*self.w].decode("ascii")
+            self._rows[y] = row
+        return row
+
+    def __len__(self):
+        return self.h
+
+    def __iter__(self):
+        for y in range(self.h):
+            yield self[y]
+
+    # Returns the tile at x,y, or None if it's off the map.
+    def get(self, x, y):
+        if x < 0 or y < 0 or x >= self.w or y >= self.h:
+            return None
+        return chr(self.cells[y*self.w+x])
+
+    # Change the tile at x,y.
+    def set(self, x, y, c):
+        i = y*self.w+x
+        self.cells[i] = ord(c)
+        self.opaque[i] = 1 if c in OPAQUE else 0
+        self.passable[i] = 0 if c in SOLID else 1
+        self._rows[y] = None
+
+    # Returns true if x,y is on the map and can be walked on.
+    def is_free(self, x, y):
+        if x < 0 or y < 0 or x >= self.w or y >= self.h:
+            return False
+        return self.passable[y*self.w+x] == 1
+
+    # Returns true if x,y blocks vision. Everything off the map does.
+    def is_opaque(self, x, y):
+        if x < 0 or y < 0 or x >= self.w or y >= self.h:
+            return True
+        return self.opaque[y*self.w+x] == 1
@@ -1,12 +1,33 @@
 from core import gfx
 from core import log
+from core.tilemap import TileMap
 
+import array
+import bisect
+import heapq
+import itertools
+import math
 import random
+from collections import OrderedDict, deque
 
+# NumPy is optional. Without it, the EntityStore keeps its columns in plain
+# arrays and does its perception one entity at a time.
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
-# The ring function returns all of the tiles that make up the ring of radius
-# 'r' around (x,y).
-def ring(x,y,r):
+
+# Rings are the same shape everywhere, save for the parity of the row they are
+# centered on, so we only walk each (radius, parity) once and keep the offsets
+# around. Rings bigger than RING_CACHE_RADIUS are walked every time instead of
+# being stored.
+RING_CACHE_RADIUS = 32
+_ring_cache = {}
+
+# Walk around the ring of radius 'r' centered on (x,y). This is the slow way
+# of getting a ring, and is used to fill the cache.
+def _walk_ring(x,y,r):
     report = []
     odd = True if y % 2 == 1 else False
     
@@ -40,62 +61,125 @@ def ring(x,y,r):
         y -= 1
         report.append((x,y))
         odd = not odd
-    
-    # Return the report. Note that the 0-degree tile is at the beginning and
-    # end of the list.
     return report
 
-# The arc method takes a list of tuples containing "start_degree, end_degree"
-# pairs. It returns the sublist of a complete ring that fits within the starts
-# and ends.
-def arc(x, y, r, endpoints):
-    if r < 1:
-        return [(x,y)]
-    orig = ring(x,y,r)
+# Returns the (dx,dy) offsets of the ring of radius 'r' around a tile on an
+# even (odd=0) or odd (odd=1) row. The result is shared, so don't modify it.
+def ring_offsets(r, odd):
+    offsets = _ring_cache.get((r,odd))
+    if offsets is None:
+        offsets = tuple(_walk_ring(0,odd,r))
+        offsets = tuple((dx,dy-odd) for (dx,dy) in offsets)
+        if r <= RING_CACHE_RADIUS:
+            _ring_cache[(r,odd)] = offsets
+    return offsets
+
+# The ring function returns all of the tiles that make up the ring of radius
+# 'r' around (x,y). Note that the 0-degree tile is at the beginning and end of
+# the list.
+def ring(x,y,r):
+    return [(x+dx,y+dy) for (dx,dy) in ring_offsets(r, y&1)]
+
+# Returns the (start,stop) index ranges of the ring of radius 'r' that fall
+# within the "start_degree, end_degree" pairs in 'endpoints'. These can be
+# used to slice ring_offsets(r,odd) without building the whole ring.
+def arc_ranges(r, endpoints):
+    n = r*6
+    chunk_size = 360.0 / n
+    h_chunk = chunk_size / 2
     report = []
     for (st, en) in endpoints:
-        chunk_size = 360.0 / (r*6)
-        h_chunk = chunk_size / 2
         while st < 0:
             st += 360
             en += 360
         if en-st > 359:
-            return orig
+            return [(0,n+1)]
         if st < en:
-            st_i = int(1.0*(st+h_chunk) / chunk_size) % (r*6)
-            en_i = int(1.0*(en+h_chunk) / chunk_size) % (r*6)
+            st_i = int(1.0*(st+h_chunk) / chunk_size) % n
+            en_i = int(1.0*(en+h_chunk) / chunk_size) % n
             if st_i <= en_i:
-                report += orig[st_i:en_i+1]
+                report.append((st_i,en_i+1))
             else:
-                report += orig[st_i:]
-                report += orig[:en_i+1]
+                # The tail includes the repeated 0-degree tile.
+                report.append((st_i,n+1))
+                report.append((0,en_i+1))
     return report
 
-# This returns the distance between two tiles.
-# Algorithm: First, walk down/diagonally until at the same row. Then
-# calculate horizontal distance.
+# Iterate over the tiles of an arc without building a list for it. See arc.
+def iter_arc(x, y, r, endpoints):
+    if r < 1:
+        yield (x,y)
+        return
+    offsets = ring_offsets(r, y&1)
+    for (st_i, en_i) in arc_ranges(r, endpoints):
+        for i in range(st_i, en_i):
+            dx,dy = offsets[i]
+            yield (x+dx,y+dy)
+
+# The arc method takes a list of tuples containing "start_degree, end_degree"
+# pairs. It returns the sublist of a complete ring that fits within the starts
+# and ends.
+def arc(x, y, r, endpoints):
+    return list(iter_arc(x, y, r, endpoints))
+
+# Convert offset coordinates into cube coordinates. Our maps use "odd-row"
+# offsets (odd rows are shoved half a tile to the right), which are easy to
+# store but awkward to do math on. In cube coordinates every hex is a point
+# (q,r,s) on the plane q+r+s = 0, and distances become simple arithmetic.
+def to_cube(x,y):
+    q = x - (y - (y&1))//2
+    return q, y, -q-y
+
+# Convert cube coordinates back into odd-row offset coordinates.
+def from_cube(q,r,s=None):
+    return q + (r - (r&1))//2, r
+
+# This returns the distance between two tiles. In cube coordinates, this is
+# just the largest of the three axis differences, so it doesn't matter how
+# far apart the tiles are.
 def distance( pos1, pos2 ):
     x1,y1 = pos1
     x2,y2 = pos2
-    if x1 > x2:
-        x1,y1 = pos2
-        x2,y2 = pos1
-      
-    # First, go diagonally and left. pos2 is guaranteed to be to the right
-    # of pos1, which helps us deal with the assumptions of how to handle odd
-    # rows.
-    dist = 0
-    odd = True if y2 % 2 == 1 else False
-    dy = 1 if y1 > y2 else -1
-    while y1 != y2:
-        if x1 < x2:
-            if not odd: x2 -= 1
-        y2 += dy
-        odd = not odd
-        dist += 1
-    dist += x2-x1
-    
-    return dist
+    dq = (x1 - (y1 - (y1&1))//2) - (x2 - (y2 - (y2&1))//2)
+    dr = y1 - y2
+    return (abs(dq) + abs(dr) + abs(dq+dr))//2
+
+# Batched version of distance. Returns a list with the distance from 'origin'
+# to each of the tiles in 'targets', in the same order. The origin only gets
+# converted once, which adds up when scoring a lot of tiles at a time.
+def distances( origin, targets ):
+    x1,y1 = origin
+    q1 = x1 - (y1 - (y1&1))//2
+    report = []
+    for (x2,y2) in targets:
+        dq = q1 - (x2 - (y2 - (y2&1))//2)
+        dr = y1 - y2
+        report.append((abs(dq) + abs(dr) + abs(dq+dr))//2)
+    return report
+
+# The corners of a ring, in cube (q,r) steps, starting at 0 degrees and going
+# counter clockwise, the same way ring walks. Side k of a ring of radius 'r'
+# starts at r*_corners[k] and walks towards the next corner.
+_corners = ((1,0),(1,-1),(0,-1),(-1,0),(-1,1),(0,1))
+
+# Returns the index of the tile (dq,dr) away from the center within the ring
+# of radius 'r', where (dq,dr) is a cube coordinate difference.
+def _ring_index(dq,dr,r):
+    if dq == r and dr > -r: return -dr
+    elif dr == -r and dq > 0: return r + (r-dq)
+    elif dq+dr == -r and dq > -r: return 2*r - dq
+    elif dq == -r and dr < r: return 3*r + dr
+    elif dr == r and dq < 0: return 4*r + (dq+r)
+    else: return 5*r + dq
+
+# Returns the (x,y) of tile 'i' on the ring of radius 'r' around (x,y).
+def _ring_point(x,y,r,i):
+    k,j = divmod(i,r)
+    cq,cr = _corners[k]
+    nq,nr = _corners[(k+1)%6]
+    q = x - (y - (y&1))//2 + r*cq + j*(nq-cq)
+    y += r*cr + j*(nr-cr)
+    return q + (y - (y&1))//2, y
 
 # This returns the angle between two tiles.
 def angle( pos1, pos2 ):
@@ -105,11 +189,12 @@ def angle( pos1, pos2 ):
     x1,y1 = pos1
     x2,y2 = pos2
     
-    # Basically create a ring around pos1, and then find the position
-    # in the ring of pos2.
-    r = distance(pos1,pos2)
-    orig = ring(x1,y1,r)
-    i = orig.index(pos2)
+    # Find the position of pos2 in the ring around pos1, straight from the
+    # cube coordinates rather than by building the ring and searching it.
+    dq = (x2 - (y2 - (y2&1))//2) - (x1 - (y1 - (y1&1))//2)
+    dr = y2 - y1
+    r = (abs(dq) + abs(dr) + abs(dq+dr))//2
+    i = _ring_index(dq,dr,r)
     angle = i * 360.0 / (r*6)
     
     return angle
@@ -120,11 +205,10 @@ def apoint(x,y,r,theta):
     if r == 0:
         return (x,y)
     theta = theta%360
-    orig = ring(x,y,r)
     chunk_size = 360.0 / (r*6)
     h_chunk = chunk_size / 2
     i = int(1.0*(theta+h_chunk) / chunk_size) % (r*6)
-    return orig[i]
+    return _ring_point(x,y,r,i)
 
 # Return a line of points from x,y to apoint(r,theta).
 def aline(x,y,r,theta):
@@ -133,9 +217,44 @@ def aline(x,y,r,theta):
         report.append( apoint(x,y,i,theta) )
     return report
 
-# Version of "aline" that let's you enter two x,y points.
+# Rounds fractional cube coordinates to the hex that contains them.
+def cube_round(q,r,s):
+    rq = math.floor(q+0.5)
+    rr = math.floor(r+0.5)
+    rs = math.floor(s+0.5)
+    dq,dr,ds = abs(rq-q),abs(rr-r),abs(rs-s)
+    if dq > dr and dq > ds: rq = -rr-rs
+    elif dr > ds: rr = -rq-rs
+    else: rs = -rq-rr
+    return int(rq),int(rr),int(rs)
+
+# Yields the tiles on the straight line from pos1 to pos2, not including pos1.
+# The line is found by stepping evenly between the two tiles in cube
+# coordinates and rounding to the nearest hex, with a tiny nudge so that a
+# line running exactly between two tiles always picks the same one. If you
+# give it an 'opaque' function that takes x,y, the line stops at the first
+# opaque tile (which is still yielded).
+def hex_line(pos1, pos2, opaque=None):
+    n = distance(pos1,pos2)
+    q1,r1,s1 = to_cube(*pos1)
+    q2,r2,s2 = to_cube(*pos2)
+    q1,r1,s1 = q1+1e-6,r1+2e-6,s1-3e-6
+    for i in range(1,n+1):
+        t = 1.0*i/n
+        q,r,s = cube_round(q1+(q2-q1)*t,r1+(r2-r1)*t,s1+(s2-s1)*t)
+        pos = q + (r - (r&1))//2, r
+        yield pos
+        if opaque and opaque(*pos):
+            return
+
+# Batched version of hex_line. Returns a list with the line from 'origin' to
+# each of the 'targets', in the same order.
+def hex_lines(origin, targets, opaque=None):
+    return [list(hex_line(origin,t,opaque)) for t in targets]
+
+# Return the line of points from pos1 to pos2, not including pos1.
 def line(pos1,pos2):
-    return aline(pos1[0],pos1[1],distance(pos1,pos2),angle(pos1,pos2))
+    return list(hex_line(pos1,pos2))
 
 
 # This takes the definition of an arc (a set of (st,en) tuples) and
@@ -178,17 +297,207 @@ def split_arc(arc, angle, size):
             
     return report
 
+# Turns a list of "start_degree, end_degree" pairs into a sorted list of
+# disjoint intervals within 0 to 360. Anything spanning a full turn becomes the
+# whole circle, and empty pairs are dropped.
+def normalize_arc(endpoints):
+    pieces = []
+    for (st,en) in endpoints:
+        width = en-st
+        if width >= 360:
+            return [(0.0,360.0)]
+        if width <= 0:
+            continue
+        st = st%360.0
+        en = st+width
+        if en > 360:
+            pieces.append((st,360.0))
+            pieces.append((0.0,en-360))
+        else:
+            pieces.append((st,en))
+    pieces.sort()
+    report = []
+    for (st,en) in pieces:
+        if report and st <= report[-1][1]:
+            if en > report[-1][1]: report[-1] = (report[-1][0],en)
+        else:
+            report.append((st,en))
+    return report
+
+# Returns the angles covered by tile 'k' of the ring of radius 'r' as a list
+# of (start,end) pieces. The 0-degree tile straddles 0, so it also comes back
+# a second time on the far side of 360.
+def tile_span(r,k):
+    chunk_size = 360.0 / (r*6)
+    if k == 0:
+        return [(-0.5*chunk_size,0.5*chunk_size),
+                ((r*6-0.5)*chunk_size,(r*6+0.5)*chunk_size)]
+    return [((k-0.5)*chunk_size,(k+0.5)*chunk_size)]
+
+# Cuts the angles from lo to hi out of a sorted list of disjoint intervals.
+def _shade(intervals, lo, hi):
+    i = max(bisect.bisect_left(intervals,(lo,))-1,0)
+    j = i
+    kept = []
+    while j < len(intervals) and intervals[j][0] < hi:
+        st,en = intervals[j]
+        if en > lo:
+            if st < lo: kept.append((st,lo))
+            if en > hi: kept.append((hi,en))
+        else:
+            kept.append((st,en))
+        j += 1
+    intervals[i:j] = kept
+
+# Yields the index of every tile in the ring of radius 'r' that overlaps the
+# sorted, disjoint intervals in 'visible', each one once.
+def _arc_indices(visible, r):
+    n = r*6
+    chunk_size = 360.0 / n
+    last = -1
+    zero = False
+    for (st,en) in visible:
+        # Tile k covers (k-0.5) to (k+0.5) chunks, counting the 0-degree tile
+        # a second time as tile n. Find the first and last tiles that overlap
+        # this interval; everything between them does too.
+        first = max(int(st/chunk_size+0.5)-1,0)
+        while (first+0.5)*chunk_size <= st: first += 1
+        final = min(int(en/chunk_size+0.5)+1,n)
+        while (final-0.5)*chunk_size >= en: final -= 1
+        for k in range(max(first,last+1),final+1):
+            if k == 0: zero = True
+            elif k == n:
+                if zero: continue
+                k = 0
+            yield k
+        last = max(last,final)
+
+# Hex shadowcasting. Walks outwards one ring at a time, keeping a sorted list
+# of the angles that are still visible. Only the tiles that fall within those
+# angles get looked at, and every opaque one casts a shadow over its whole
+# width for the rings behind it. A tile can be seen if any part of it lies in
+# the visible angles. 'opaque' is a function that takes x,y. Returns every
+# visible tile exactly once.
+def shadowcast(x, y, r, angles, opaque):
+    report = [(x,y)]
+    visible = normalize_arc(angles)
+    odd = y&1
+    for i in range(1,r+1):
+        if not visible:
+            break
+        offsets = ring_offsets(i,odd) if i <= RING_CACHE_RADIUS else None
+        blockers = []
+        for k in _arc_indices(visible,i):
+            if offsets:
+                dx,dy = offsets[k]
+                pos = (x+dx,y+dy)
+            else:
+                pos = _ring_point(x,y,i,k)
+            report.append(pos)
+            if opaque(*pos): blockers.append(k)
+        for k in blockers:
+            for (lo,hi) in tile_span(i,k):
+                _shade(visible,lo,hi)
+    return report
+
+# Shadowcasting towards a single tile. Only the sliver of angles covered by
+# the target (and inside 'angles') is followed, so only the tiles that could
+# possibly cast a shadow on it are looked at. Gives the same answer as
+# checking whether pos2 is in shadowcast(), for a fraction of the work.
+def shadowcast_to(pos1, pos2, r, angles, opaque):
+    if pos1 == pos2:
+        return True
+    x,y = pos1
+    x2,y2 = pos2
+    dq = (x2 - (y2 - (y2&1))//2) - (x - (y - (y&1))//2)
+    dr = y2 - y
+    d = (abs(dq) + abs(dr) + abs(dq+dr))//2
+    if d > r:
+        return False
+    visible = []
+    for (lo,hi) in tile_span(d,_ring_index(dq,dr,d)):
+        for (st,en) in normalize_arc(angles):
+            if st < hi and en > lo:
+                visible.append((max(st,lo),min(en,hi)))
+    visible.sort()
+    for i in range(1,d):
+        if not visible:
+            break
+        blockers = [k for k in _arc_indices(visible,i)
+                    if opaque(*_ring_point(x,y,i,k))]
+        for k in blockers:
+            for (lo,hi) in tile_span(i,k):
+                _shade(visible,lo,hi)
+    return len(visible) > 0
+
+
 # Get the X,Y coordinates of the neighbor of x,y in direction d.
 #   2 1    Returns None if no such direction.
 #  3 @ 0
 #   4 5
 def direction(x, y, d):
     if d < 0 or d > 5: return None
-    else: return ring(x,y,1)[d]
+    dx,dy = ring_offsets(1, y&1)[d]
+    return (x+dx,y+dy)
+
+
+# A Visibility is the set of tiles that can be seen by someone, as returned by
+# World.fov. Checking whether a tile is in it is a set lookup rather than a
+# search, and visibilities can be combined with | and &. The bounds are the
+# smallest (x1,y1,x2,y2) box containing every tile, or None if it's empty.
+class Visibility(object):
+    def __init__(self, tiles):
+        self._order = tuple(tiles)
+        self.tiles = frozenset(self._order)
+        if self.tiles:
+            xs = [x for (x,y) in self.tiles]
+            ys = [y for (x,y) in self.tiles]
+            self.bounds = min(xs),min(ys),max(xs),max(ys)
+        else:
+            self.bounds = None
+    
+    def __contains__(self, pos):
+        return pos in self.tiles
+    
+    def __iter__(self):
+        return iter(self.tiles)
+    
+    def __len__(self):
+        return len(self.tiles)
+    
+    def __eq__(self, other):
+        return isinstance(other, Visibility) and self.tiles == other.tiles
+    
+    def __ne__(self, other):
+        return not self == other
+    
+    def __hash__(self):
+        return hash(self.tiles)
+    
+    def union(self, other):
+        return Visibility(self._order+tuple(p for p in other._order
+                                            if p not in self.tiles))
+    __or__ = union
+    
+    def intersection(self, other):
+        return Visibility(p for p in self._order if p in other.tiles)
+    __and__ = intersection
+    
+    # Returns the tiles as a list, in the order the FOV engine found them,
+    # like fov used to.
+    def to_list(self):
+        return list(self._order)
 
 
-# An entity is anything that exists in the world.
-class Entity(object):
+# An entity is anything that exists in the world. EntityBase is everything an
+# entity does, and the attributes that are never stored in columns. Entity adds
+# slots for the numbers, and StoredEntity (below) keeps them in an EntityStore
+# instead. Entities have slots rather than a __dict__, so they're smaller, and
+# setting an attribute that isn't listed is an error rather than a typo that
+# goes unnoticed.
+class EntityBase(object):
+    __slots__ = ("name","char","target","toughness")
+    
     def __init__(self, name, x, y):
         self.name = name
         self.x = x
@@ -197,6 +506,7 @@ class Entity(object):
         self.target = None
         self.angle = 0
         self.lense = 30
+        self.sight = 10
         self.hp = 5
         self.speed = 10
         self.toughness = 1
@@ -207,7 +517,7 @@ class Entity(object):
         pos = direction(self.x, self.y, way)
         if pos and world.is_free(*pos):
             if not self.target: self.angle = angle((self.x,self.y),pos)
-            self.x, self.y = pos
+            world.move_entity(self, *pos)
             self.init -= 5
         
 
@@ -224,224 +534,655 @@ class Entity(object):
     def ai(self, world):
         self.init -= 1
         if self.hp > 0:
-            my_fov = world.fov(self.x,self.y,10,[(self.angle-self.lense,self.angle+self.lense)])
             foundem = False
-            for (x,y) in my_fov:
-                if (x,y) == (world.player.x,world.player.y) and world.player.hp > 0:
-                    self.target = x,y
-                    foundem = True
+            pos = world.player.x,world.player.y
+            if world.player.hp > 0 and world.can_see(self,pos):
+                self.target = pos
+                foundem = True
             if foundem:
                 self.fire(world)
             else:
-                self.move(random.randint(0,6), world)
+                self.move(world.random.randint(0,6), world)
     
     # Here we try to fire in the direction of the target.
     def fire(self, world):
-        if self.target:
+        if self.target and self.target != (self.x,self.y):
             d = distance((self.x,self.y),self.target)
-            error = random.randint(max(-d,-60),min(d,60))
-            world.bullet_anim = aline(self.x,self.y,
-                             distance((self.x,self.y),self.target),
-                             error+angle((self.x,self.y),self.target))
+            error = world.random.randint(max(-d,-60),min(d,60))
+            end = apoint(self.x,self.y,d,
+                         error+angle((self.x,self.y),self.target))
+            world.bullet_anim = world.trace((self.x,self.y),end)
             world.bullet_power = self.toughness
+            world.shooter = self
+            if self is world.player: world.stats["shots"] += 1
             self.init -= 4
             world.gui_log("BANG!")
             
 
+class Entity(EntityBase):
+    __slots__ = ("x","y","angle","lense","sight","hp","speed","init")
+
+
+# Returns true if someone at (x,y) facing 'theta' with a view 'lense' degrees
+# either side and 'sight' tiles deep might see (x2,y2), going only by distance
+# and direction. Walls aren't looked at, so this can say yes when can_see would
+# say no, but never the other way around: the target is in the cone if any
+# part of its tile is.
+def in_cone(x, y, theta, lense, sight, x2, y2):
+    dq = (x2 - (y2 - (y2&1))//2) - (x - (y - (y&1))//2)
+    dr = y2 - y
+    d = (abs(dq) + abs(dr) + abs(dq+dr))//2
+    if d > sight:
+        return False
+    if d == 0:
+        return True
+    off = abs((_ring_index(dq,dr,d)*60.0/d - theta + 180) % 360 - 180)
+    return off < lense + 30.0/d + 1e-9
+
+
+# The EntityStore keeps the numbers of many entities in columns, one array per
+# attribute with one slot per entity, rather than in each entity. That lets
+# perceive look at every entity at once instead of one at a time. Columns are
+# NumPy arrays if NumPy is around, and arrays from the array module if not.
+# The entities themselves are StoredEntity proxies that read and write their
+# slot. Slots of removed entities are reused.
+class EntityStore(object):
+    COLUMNS = [("x","l"),("y","l"),("hp","l"),("init","l"),("speed","l"),
+               ("angle","d"),("lense","l"),("sight","l")]
+    
+    # Writing any of these means perceive's answer for that entity is stale.
+    SIGHT = frozenset(["x","y","hp","angle","lense","sight"])
+    
+    def __init__(self, capacity=64, use_numpy=None):
+        if use_numpy is None:
+            use_numpy = numpy is not None
+        self.numpy = use_numpy
+        self.capacity = 0
+        self.cols = {}
+        self.used = None
+        self.proxies = []
+        self._free = []
+        self._seen = None
+        self.touched = set()
+        self._grow(capacity)
+    
+    def _grow(self, capacity):
+        extra = capacity - self.capacity
+        if self.numpy:
+            types = {"l": numpy.int64, "d": numpy.float64}
+            for name,t in self.COLUMNS:
+                col = numpy.zeros(capacity, types[t])
+                if name in self.cols:
+                    col[:self.capacity] = self.cols[name]
+                self.cols[name] = col
+            used = numpy.zeros(capacity, bool)
+            if self.used is not None:
+                used[:self.capacity] = self.used
+            self.used = used
+        else:
+            for name,t in self.COLUMNS:
+                self.cols.setdefault(name,array.array(t)).extend([0]*extra)
+            if self.used is None:
+                self.used = array.array("b")
+            self.used.extend([0]*extra)
+        self.proxies.extend([None]*extra)
+        self._free.extend(range(capacity-1,self.capacity-1,-1))
+        self.capacity = capacity
+        
+        # A function per column that reads a slot as a plain Python number.
+        self.readers = dict((name,col.item if self.numpy else col.__getitem__)
+                            for (name,col) in self.cols.items())
+    
+    # Takes a free slot for entity e and returns its index.
+    def add(self, e):
+        if not self._free:
+            self._grow(self.capacity*2)
+        i = self._free.pop()
+        self.used[i] = 1
+        self.proxies[i] = e
+        self.touched.add(i)
+        return i
+    
+    def remove(self, i):
+        self.used[i] = 0
+        self.proxies[i] = None
+        self._free.append(i)
+    
+    def read(self, name, i):
+        return self.readers[name](i)
+    
+    def write(self, name, i, v):
+        self.cols[name][i] = v
+        if name in self.SIGHT:
+            self.touched.add(i)
+    
+    # Works out, for every living entity at once, whether it might see (x,y)
+    # according to in_cone, and remembers the answer for may_see. Returns the
+    # entities that might, which are the only ones worth a line of sight
+    # check.
+    def perceive(self, x, y):
+        if self.numpy:
+            c = self.cols
+            ex,ey = c["x"],c["y"]
+            dq = (x - (y - (y&1))//2) - (ex - (ey - (ey&1))//2)
+            dr = y - ey
+            d = (numpy.abs(dq) + numpy.abs(dr) + numpy.abs(dq+dr))//2
+            i = numpy.select([(dq == d) & (dr > -d),
+                              (dr == -d) & (dq > 0),
+                              (dq+dr == -d) & (dq > -d),
+                              (dq == -d) & (dr < d),
+                              (dr == d) & (dq < 0)],
+                             [-dr, 2*d-dq, 2*d-dq, 3*d+dr, 5*d+dq],
+                             5*d+dq)
+            far = numpy.maximum(d,1)
+            off = numpy.abs((i*60.0/far - c["angle"] + 180) % 360 - 180)
+            seen = (self.used & (c["hp"] > 0) & (d <= c["sight"]) &
+                    ((d == 0) | (off < c["lense"] + 30.0/far + 1e-9)))
+            found = set(numpy.flatnonzero(seen).tolist())
+        else:
+            c = self.cols
+            found = set()
+            for i in range(self.capacity):
+                if (self.used[i] and c["hp"][i] > 0 and
+                    in_cone(c["x"][i],c["y"][i],c["angle"][i],c["lense"][i],
+                            c["sight"][i],x,y)):
+                    found.add(i)
+        self._seen = (x,y,found)
+        self.touched = set()
+        return [self.proxies[i] for i in found]
+    
+    # Returns false if the entity in slot i can't possibly see (x,y). Uses the
+    # last perceive if it was about (x,y) and the entity hasn't changed since.
+    def may_see(self, i, x, y):
+        if (self._seen is not None and self._seen[:2] == (x,y) and
+            i not in self.touched):
+            return i in self._seen[2]
+        return in_cone(self.read("x",i),self.read("y",i),
+                       self.read("angle",i),self.read("lense",i),
+                       self.read("sight",i),x,y)
+
+
+# Returns a property that reads and writes column 'name' of the entity's slot
+# in its store. This is what every attribute access of a StoredEntity goes
+# through, so it skips the store's own read and write.
+def _column(name):
+    touches = name in EntityStore.SIGHT
+    def get(self):
+        return self.store.readers[name](self.i)
+    def put(self, v):
+        self.store.cols[name][self.i] = v
+        if touches: self.store.touched.add(self.i)
+    return property(get,put)
+
+# A StoredEntity is an entity whose numbers live in an EntityStore, read and
+# written through properties, so it works anywhere an Entity does.
+class StoredEntity(EntityBase):
+    __slots__ = ("store","i")
+    
+    def __init__(self, store, name, x, y):
+        self.store = store
+        self.i = store.add(self)
+        EntityBase.__init__(self, name, x, y)
+    
+    x = _column("x")
+    y = _column("y")
+    hp = _column("hp")
+    init = _column("init")
+    speed = _column("speed")
+    angle = _column("angle")
+    lense = _column("lense")
+    sight = _column("sight")
+
+
 # The World is our view into the tiled game world. Entities exist within the
-# world and are located at x,y coordinates that represent tiles.
+# world and are located at x,y coordinates that represent tiles. Everything
+# left to chance in a world is decided by its own random number generator, so
+# two worlds made from the same seed and given the same keys play out the same.
+# With no seed, the world is different every time. With use_store, the player
+# and the bad guys are kept in an EntityStore, which makes levels with lots of
+# robots cheaper.
 class World(object):
-    def __init__(self):
+    def __init__(self, w=40, h=40, seed=None, use_store=False):
+        self.size = w,h
+        self.use_store = use_store
+        self.seed = seed
+        self.random = random.Random(seed)
+        self.map_version = 0
+        self.fov_cache_size = 256
+        self.fov_hits = 0
+        self.fov_misses = 0
+        self._fov_cache = OrderedDict()
+        self._fov_version = 0
+        self.fov_engine = "arc"
+        self.screen = gfx.Compositor(["terrain","actors","effects","hud"])
+        self.view_size = 20,20
+        self.round = 0
+        self.turn_budget = 64
         self.new_world(1)
         self.running = True
         self.dead_clock = 800
         self.difficulty = 1
         self.bullet_power = 0
+        self.shooter = None
         self.log = ["May the best @ win!"]
+        self.changed = True
+        
+        # Running totals for the whole game, across levels: rounds played,
+        # levels cleared, and the player's shots and how many of them hit.
+        self.stats = {"turns": 0, "levels": 0, "shots": 0, "hits": 0}
+        self.inputs = deque()
+    
+    # Returns the state of the world's random number generator, to be given to
+    # set_random_state later to pick up from this point again.
+    def random_state(self):
+        return self.random.getstate()
+    
+    def set_random_state(self, state):
+        self.random.setstate(state)
     
     def new_world(self, enemies):
-        self.w = 40
-        self.h = 40
+        self.w, self.h = self.size
         self.camera = 0,0
-        self.map = ["."*self.w]*self.h
-        self.player = Entity("Player",15,5)
-        self.entities = [self.player]
+        self.map = TileMap(self.w,self.h)
+        self.map_version += 1
+        self.store = EntityStore() if self.use_store else None
+        self.player = self.spawn("Player",15,5)
+        self.entities = []
         self.stuff = []
+        self._entities_at = {}
+        self._stuff_at = {}
+        self._schedule = []
+        self._seq = {}
+        self._seqs = itertools.count()
+        self.add_entity(self.player)
         self.player.char = "@"
         self.bullet_anim = []
         self.anim_tick = 0
         self.anim_speed = 2
-        self.turn = 0
         
         for a in range(self.h):
             for b in range(self.w):
-                if random.randint(0,100) < 5:
-                    self.map[a] = self.map[a][:b]+"#"+self.map[a][b+1:]
-                elif random.randint(0,100) < 1:
-                    x = random.randint(0,3)
+                if self.random.randint(0,100) < 5:
+                    self.set_tile(b,a,"#")
+                elif self.random.randint(0,100) < 1:
+                    x = self.random.randint(0,3)
                     if x == 0:
                         e = Entity("+Health",b,a)
                         e.char = "+"
-                        self.stuff.append(e)
+                        self.add_stuff(e)
                     elif x == 1: 
                         e = Entity("!Toughness",b,a)
                         e.char = "!"
-                        self.stuff.append(e)
+                        self.add_stuff(e)
                     elif x == 2: 
                         e = Entity(">Fastness",b,a)
                         e.char = ">"
-                        self.stuff.append(e)
+                        self.add_stuff(e)
         
         for a in range(enemies):
-            e = Entity("Bad Guy",random.randint(5,35),random.randint(5,35))
+            e = self.spawn("Bad Guy",self.random.randint(5,self.w-5),
+                              self.random.randint(5,self.h-5))
             e.char = "@"
-            self.entities.append(e)
+            self.add_entity(e)
+        self.follow()
+    
+    # Turns are handed out by a schedule: a heap of (round, seq, entity), where
+    # seq is the order the entity was added in. Whoever is on top goes next,
+    # and keeps going until their init runs out. Then their speed is added
+    # back and they wait for the next round. Entities that are removed or
+    # dead are only dropped from the heap when they get to the top.
+    def next_up(self):
+        while True:
+            r,seq,e = self._schedule[0]
+            if self._seq.get(e) != seq:
+                heapq.heappop(self._schedule)
+            elif e.hp <= 0 and e is not self.player:
+                heapq.heappop(self._schedule)
+                del self._seq[e]
+            else:
+                if r > self.round:
+                    self.round = r
+                    self.stats["turns"] += 1
+                return e
+    
+    # Call after e, who is next up, has done something.
+    def _end_action(self, e):
+        if e.init < 0:
+            r,seq,e = self._schedule[0]
+            e.init += e.speed
+            heapq.heapreplace(self._schedule,(r+1,seq,e))
+    
+    # Make a new entity, in the store if we're using one. It still has to be
+    # added to the world with add_entity.
+    def spawn(self, name, x, y):
+        if self.store is not None:
+            return StoredEntity(self.store,name,x,y)
+        return Entity(name,x,y)
+    
+    # Entities and stuff are also filed by the tile they're standing on, so that
+    # finding what's at a tile doesn't mean looking at everything. Anything
+    # that adds, removes or moves them should go through these.
+    def add_entity(self, e):
+        self.entities.append(e)
+        self._entities_at.setdefault((e.x,e.y),[]).append(e)
+        seq = next(self._seqs)
+        self._seq[e] = seq
+        heapq.heappush(self._schedule,(self.round,seq,e))
+    
+    def remove_entity(self, e):
+        self.entities.remove(e)
+        self._unfile(self._entities_at,e)
+        self._seq.pop(e,None)
+        if isinstance(e,StoredEntity):
+            e.store.remove(e.i)
+    
+    def move_entity(self, e, x, y):
+        self._unfile(self._entities_at,e)
+        e.x, e.y = x, y
+        self._entities_at.setdefault((x,y),[]).append(e)
+    
+    def add_stuff(self, s):
+        self.stuff.append(s)
+        self._stuff_at.setdefault((s.x,s.y),[]).append(s)
     
-    # Returns true if a square is free.
+    def remove_stuff(self, s):
+        self.stuff.remove(s)
+        self._unfile(self._stuff_at,s)
+    
+    def _unfile(self, index, e):
+        bucket = index[(e.x,e.y)]
+        bucket.remove(e)
+        if not bucket: del index[(e.x,e.y)]
+    
+    # Returns the entities (or stuff) at x,y. Don't modify the list.
+    def entities_at(self, x, y):
+        return self._entities_at.get((x,y),())
+    
+    def stuff_at(self, x, y):
+        return self._stuff_at.get((x,y),())
+    
+    # Returns the entities (or stuff) within the box from (x1,y1) to (x2,y2),
+    # inclusive.
+    def entities_in(self, x1, y1, x2, y2):
+        return self._filed_in(self._entities_at,x1,y1,x2,y2)
+    
+    def stuff_in(self, x1, y1, x2, y2):
+        return self._filed_in(self._stuff_at,x1,y1,x2,y2)
+    
+    def _filed_in(self, index, x1, y1, x2, y2):
+        report = []
+        if (x2-x1+1)*(y2-y1+1) < len(index):
+            for y in range(y1,y2+1):
+                for x in range(x1,x2+1):
+                    report += index.get((x,y),())
+        else:
+            for (x,y),bucket in index.items():
+                if x1 <= x <= x2 and y1 <= y <= y2:
+                    report += bucket
+        return report
+    
+    # Change the tile at x,y. Anything that changes the map should go through
+    # here so that the cached fields of vision get thrown away.
+    def set_tile(self, x, y, c):
+        self.map.set(x,y,c)
+        self.map_version += 1
+    
+    # Returns true if a square is free. The map decides.
     def is_free(self, x, y):
-        if x < 0 or y < 0 or x >= self.w or y >= self.h:
-            return False
-        if self.map[y][x] != "#":
-            return True
-        return False
+        return self.map.is_free(x,y)
+    
+    # Returns true if a square blocks vision.
+    def is_opaque(self, x, y):
+        return self.map.is_opaque(x,y)
     
     # Do field of vision calculations in the world. Causes breaks in
     # opaque tiles. Normally goes in all directions, but you can constrain it.
+    # Results are remembered until the map changes, so most entities standing
+    # still cost nothing to look around. Returns a Visibility. The fov_engine
+    # picks the algorithm: "arc", the default, is the original ring sweep, and
+    # "shadow" is hex shadowcasting, which copes much better with long sight
+    # and lots of walls. They don't agree on every tile, so switching changes
+    # what everyone can see.
     def fov(self,x,y,r,angles=[(0,360)]):
+        if self._fov_version != self.map_version:
+            self._fov_cache.clear()
+            self._fov_version = self.map_version
+        key = (self.fov_engine,x,y,r,tuple(angles))
+        report = self._fov_cache.get(key)
+        if report is not None:
+            self._fov_cache.move_to_end(key)
+            self.fov_hits += 1
+            return report
+        self.fov_misses += 1
+        report = Visibility(self._fov(x,y,r,angles))
+        self._fov_cache[key] = report
+        if len(self._fov_cache) > self.fov_cache_size:
+            self._fov_cache.popitem(last=False)
+        return report
+    
+    # Returns the tiles a shot from pos1 towards pos2 passes through, up to
+    # and including the first one it hits.
+    def trace(self, pos1, pos2):
+        return list(hex_line(pos1,pos2,self.map.is_opaque))
+    
+    # Returns true if entity 'e' can see the tile at pos, according to the
+    # same rules as fov. Anything too far away or outside the entity's cone is
+    # turned down straight away. After that, the "shadow" engine follows only
+    # the angles the tile covers, which costs O(r), but the "arc" engine still
+    # works out (and caches) the entity's whole field of vision, which is
+    # O(r^2) the first time.
+    def can_see(self, e, pos):
+        if isinstance(e,StoredEntity) and not e.store.may_see(e.i,*pos):
+            return False
+        if not in_cone(e.x,e.y,e.angle,e.lense,e.sight,*pos):
+            return False
+        angles = [(e.angle-e.lense,e.angle+e.lense)]
+        if self.fov_engine == "shadow":
+            return shadowcast_to((e.x,e.y),pos,e.sight,angles,
+                                 self.map.is_opaque)
+        return pos in self.fov(e.x,e.y,e.sight,angles)
+    
+    # The uncached field of vision calculation.
+    def _fov(self,x,y,r,angles):
+        if self.fov_engine == "shadow":
+            return shadowcast(x,y,r,angles,self.map.is_opaque)
+        elif self.fov_engine != "arc":
+            raise Exception("Unknown FOV engine %s."%self.fov_engine)
+        
+        opaque = self.map.is_opaque
         report = [(x,y)]
         for i in range(1,r+1):
             view = arc(x,y,i,angles)
             for (ox,oy) in view:
-                if not self.is_free(ox,oy):
+                if opaque(ox,oy):
                     theta = angle((x,y),(ox,oy))
                     angles = split_arc(angles, theta, 180./(i*6))
             report += view
         return report
     
-    # Draws the world.
-    def draw(self, cw=20, ch=20, vx=0, vy=0):
-        cx,cy = self.camera
-        qx,qy = self.player.x, self.player.y
-        if self.player.target:
-            qx,qy = self.player.target
-        
-        dx,dy = qx-cx, qy-cy
-        
-        if dx > 15 or dx < 5:
-            cx = qx - cw/2
-        if dy > 15 or dy < 5:
-            cy = qy - ch/2
-        self.camera = cx,cy
-        
+    # Moves bullets along, one tile every anim_speed ticks, and hands out the
+    # power ups the player is standing on. Should be called once per tick.
+    def animate(self):
         self.anim_tick = (self.anim_tick + 1)%self.anim_speed
         if self.anim_tick == 0:
             if len(self.bullet_anim)>0:
                 x,y = self.bullet_anim.pop(0)
+                self.changed = True
                 if not self.is_free(x,y):
                     self.bullet_anim = []
-                for e in self.entities:
-                    if (e.x,e.y) == (x,y):
-                        e.hp -= self.bullet_power
-                        if e is self.player:
-                            self.gui_log("I'm hit!")
-                        if e.hp < 1:
-                            e.char = "%"
-                            self.gui_log("%s has died. :("%(e.name))
-                        self.bullet_anim = []
-        
-        for s in self.stuff[:]:
-            if (s.x,s.y)==(self.player.x,self.player.y):
-                self.stuff.remove(s)
-                if s.name[0] == "+":
-                    self.player.hp += 1
-                    self.gui_log("You feel healthier!")
-                elif s.name[0] == "!":
-                    self.player.toughness += 1
-                    self.gui_log("You feel tougher!")
-                elif s.name[0] == ">":
-                    self.player.speed += 1
-                    self.gui_log("You are faster now!")
-                    
+                for e in self.entities_at(x,y):
+                    e.hp -= self.bullet_power
+                    if self.shooter is self.player and e is not self.player:
+                        self.stats["hits"] += 1
+                    if e is self.player:
+                        self.gui_log("I'm hit!")
+                    if e.hp < 1:
+                        e.char = "%"
+                        self.gui_log("%s has died. :("%(e.name))
+                    self.bullet_anim = []
         
-        gfx.clear()
+        for s in list(self.stuff_at(self.player.x,self.player.y)):
+            self.remove_stuff(s)
+            self.changed = True
+            if s.name[0] == "+":
+                self.player.hp += 1
+                self.gui_log("You feel healthier!")
+            elif s.name[0] == "!":
+                self.player.toughness += 1
+                self.gui_log("You feel tougher!")
+            elif s.name[0] == ">":
+                self.player.speed += 1
+                self.gui_log("You are faster now!")
+    
+    # Keep the player facing their target, and move the camera when what the
+    # player is looking at gets too close to the edge of the view.
+    def follow(self):
         if self.player.target:
             a = angle((self.player.x,self.player.y),self.player.target)
             if a is not None: self.player.angle = a
-        my_fov = self.fov(self.player.x,self.player.y,10,[(self.player.angle-self.player.lense,self.player.angle+self.player.lense)])
+        
+        cw,ch = self.view_size
+        cx,cy = self.camera
+        qx,qy = self.player.x, self.player.y
+        if self.player.target:
+            qx,qy = self.player.target
+        
+        dx,dy = qx-cx, qy-cy
+        
+        if dx > cw*3//4 or dx < cw//4:
+            cx = qx - cw//2
+        if dy > ch*3//4 or dy < ch//4:
+            cy = qy - ch//2
+        self.camera = cx,cy
+    
+    # Advance the world by one tick. The keys pressed since the last tick are
+    # queued up for the player, whoever's turn it is gets to act, bullets move
+    # along and the camera follows the player. Everything that changes the
+    # world happens here; draw only looks at it. Returns true if there is
+    # something new to draw.
+    def step(self, keys=()):
+        self.handle_inputs(keys)
+        self.animate()
+        self.follow()
+        return self.changed
+    
+    # Advance the world by n ticks without any input, stopping early if the
+    # game ends. Returns the number of ticks taken.
+    def tick(self, n=1):
+        for i in range(n):
+            if not self.running:
+                return i
+            self.step()
+        return n
+    
+    # Draws the world into the layers of self.screen: the terrain, then the
+    # things on it, then the bullet and the reticle. A layer is only rebuilt
+    # when something it shows has changed, and the game flushes the screen
+    # once everything is drawn. Nothing in the world changes here; cw and ch
+    # should match view_size, which the camera follows.
+    def draw(self, cw=20, ch=20, vx=0, vy=0):
+        cx,cy = self.camera
+        my_fov = self.fov(self.player.x,self.player.y,self.player.sight,[(self.player.angle-self.player.lense,self.player.angle+self.player.lense)])
         #my_fov = self.fov(self.player.x,self.player.y,10)
         #my_fov = []
         #for a in range(self.w):
         #    for b in range(self.h):
         #        my_fov.append((a,b))
-        lineee = []
-        if self.player.target:
-            lineee = line((self.player.x,self.player.y),self.player.target)
-        all_fovs = {}
-        for e in self.entities:
-            all_fovs[e] = self.fov(e.x,e.y,10,[(e.angle-e.lense,e.angle+e.lense)])
-        for y in range(self.h):
-            odd = True if y % 2 == 1 else False
-            for x in range(self.w):
-                if not(x >= cx and x < cx+cw and y >= cy and y < cy+ch):
-                    continue
-            
-            
-                ax = (x-cx+vx)*2 + (1 if odd else 0)
-                ay = (y-cy+vy)
-            
-                # For each tile that can be seen, determine what will be drawn
-                # there.
-                if (x,y) in my_fov:
-                    empty = True
-                    for s in self.stuff:
-                        if (s.x,s.y) == (x,y):
-                            gfx.draw(ax,ay,s.char,"m!")
-                            empty = False
-                    for e in self.entities:
-                        if (e.x,e.y) == (x,y):
-                            gfx.draw(ax,ay,e.char,"b!" if e is self.player else "r!")
-                            empty = False
-                    if empty:
-                        c = self.map[y][x]
-                        gfx.draw(ax,ay,c,"g" if c == "." else "y")
-                    if len(self.bullet_anim)>0 and self.bullet_anim[0] == (x,y):
-                        gfx.draw(ax,ay,"*",'r')
-                else:
-                    for e in self.entities:
-                        if (e is not self.player and (e.x,e.y)==(x,y) and
-                            (self.player.x,self.player.y) in all_fovs[e]):
-                                gfx.draw(ax,ay,"\"","r!")
-                if self.player.target == (x,y):
-                    gfx.draw(ax-1,ay,"[")
-                    gfx.draw(ax+1,ay,"]")
+        
+        # Only the tiles within the camera get looked at, so the size of the
+        # map doesn't matter. Odd rows are shoved half a tile to the right.
+        x1,x2 = max(cx,0),min(cx+cw,self.w)
+        y1,y2 = max(cy,0),min(cy+ch,self.h)
+        view = (cx,cy,cw,ch,vx,vy)
+        def at(x,y):
+            return (vx-cx+x)*2+(y&1), y-cy+vy
+        
+        # The terrain only changes when the map, the camera or what the
+        # player can see does.
+        terrain = self.screen.layer("terrain")
+        if terrain.stale((view,self.map_version,my_fov)):
+            for y in range(y1,y2):
+                row = self.map[y]
+                for x in range(x1,x2):
+                    if (x,y) in my_fov:
+                        c = row[x]
+                        ax,ay = at(x,y)
+                        terrain.draw(ax,ay,c,"g" if c == "." else "y")
+        
+        # Things in sight are drawn over the terrain. The bad guys that are
+        # out of sight but can see the player show up as a pair of red eyes.
+        me = self.player.x,self.player.y
+        entities = self.entities_in(x1,y1,x2-1,y2-1)
+        stuff = self.stuff_in(x1,y1,x2-1,y2-1)
+        actors = self.screen.layer("actors")
+        if actors.stale((view,self.map_version,my_fov,
+                         tuple((e.x,e.y,e.char,e.angle,e.lense,e.sight)
+                               for e in entities),
+                         tuple((s.x,s.y,s.char) for s in stuff))):
+            for s in stuff:
+                if (s.x,s.y) in my_fov:
+                    ax,ay = at(s.x,s.y)
+                    actors.draw(ax,ay,s.char,"m!")
+            for e in entities:
+                ax,ay = at(e.x,e.y)
+                if (e.x,e.y) in my_fov:
+                    actors.draw(ax,ay,e.char,"b!" if e is self.player else "r!")
+                elif e is not self.player and self.can_see(e,me):
+                    actors.draw(ax,ay,"\"","r!")
+        
+        # The bullet and the reticle go on top of everything.
+        head = self.bullet_anim[0] if len(self.bullet_anim)>0 else None
+        if head not in my_fov: head = None
+        target = self.player.target
+        effects = self.screen.layer("effects")
+        if effects.stale((view,my_fov,head,target)):
+            if head and x1 <= head[0] < x2 and y1 <= head[1] < y2:
+                ax,ay = at(*head)
+                effects.draw(ax,ay,"*",'r')
+            if target and x1 <= target[0] < x2 and y1 <= target[1] < y2:
+                ax,ay = at(*target)
+                effects.draw(ax-1,ay,"[")
+                effects.draw(ax+1,ay,"]")
 
 
     # Draw the datalog.
     def draw_gui(self, vx=41, vy=0, vw=38, vh=20 ):
-        x = vx
-        for c in "Robot Battle":
-            gfx.draw(x,vy,c) 
-            x += 1
-        x = vx
-        for c in "Your HP: %d"%self.player.hp:
-            gfx.draw(x,vy+1,c)
-            x += 1
+        hud = self.screen.layer("hud")
+        if not hud.stale((vx,vy,vw,vh,self.player.hp,len(self.log))):
+            return
+        hud.draw_text(vx,vy,"Robot Battle")
+        hud.draw_text(vx,vy+1,"Your HP: %d"%self.player.hp)
     
     
         printy = self.log[-min(vh-3,len(self.log)):]
         y = vy+3
         for p in printy:
-            x = vx
-            for c in p[:vw]:
-                gfx.draw(x,y,c)
-                x += 1
+            hud.draw_text(vx,y,p[:vw])
             y += 1
     
     def gui_log(self, s):
         self.log.append(s)
+        self.changed = True
+    
+    
+    # Queue up a batch of keys and take a step. Keys wait in 'inputs' until it's
+    # the player's turn, instead of getting lost while the bad guys move. Every
+    # key is kept, however far behind the player falls.
+    def handle_inputs(self, keys):
+        self.inputs.extend(keys)
+        c = self.inputs[0] if self.inputs else None
+        if self.handle(c) and self.inputs:
+            self.inputs.popleft()
     
+    # Returns true if nothing will happen until the player presses a key.
+    def idle(self):
+        return (not self.inputs and not self.bullet_anim and
+                self.player.hp > 0 and
+                self.next_up() is self.player)
     
-    # Handle input.
+    # Handle input. Anything that changes what the world looks like sets
+    # 'changed', so that whoever is drawing it knows a new frame is needed.
+    # Returns true if the key was given to the player.
     def handle(self, c):
         if len(self.bullet_anim) > 0:
             return #no movement during animation
@@ -456,26 +1197,38 @@ class World(object):
         for x in self.entities:
             if x is not self.player and x.hp > 0:
                 all_dead = False
+                break
         if all_dead:
             self.gui_log("You killed all the bad guys!")
             self.gui_log("Next level...")
             self.difficulty += 1
+            self.stats["levels"] += 1
             self.new_world(self.difficulty)
         
-        # Check init.
-        current = self.entities[self.turn]
-        if current.init < 0:
-            self.turn = (self.turn+1)%len(self.entities)
-            if self.turn == 0:
-                for e in self.entities:
-                    e.init += e.speed
-                return
-        
-        
-        if current is not self.player:
+        # Everyone whose turn comes before the player's takes it now, unless
+        # someone fires, since nobody moves while a bullet is flying, or
+        # turn_budget of them have gone already. Then we pick up next time.
+        # The budget counts turns rather than time, so a seeded game plays
+        # out the same however fast the machine is.
+        # The player doesn't move while they wait, so whether each bad guy
+        # might see them is worked out for all of them at once.
+        budget = self.turn_budget
+        current = self.next_up()
+        if current is not self.player and self.store is not None:
+            self.store.perceive(self.player.x,self.player.y)
+        while current is not self.player:
             current.ai(self)
-            return
+            self._end_action(current)
+            self.changed = True
+            if len(self.bullet_anim) > 0:
+                return
+            if budget is not None:
+                budget -= 1
+                if budget <= 0:
+                    return
+            current = self.next_up()
         
+        if c is not None: self.changed = True
         if   c == "k": self.player.move(0,self)
         elif c == "i": self.player.move(1,self)
         elif c == "u": self.player.move(2,self)
@@ -499,8 +1252,9 @@ class World(object):
         elif c == "1": self.gui_log("Hello!")
         elif c == "2": self.gui_log("Goodbye!")
         
-        #if moved: self.turn = (self.turn+1)%len(self.entities)
+        self._end_action(self.player)
         
         # Debug. Logs everything that occurs in a single frame.
         log.toggle( c == 'p' )
+        return True
         
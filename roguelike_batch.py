@@ -0,0 +1,48 @@
+#! /usr/bin/env python
+
+# Plays lots of games without a screen and reports how they went. For example,
+#   python roguelike_batch.py -n 10000 -o games.jsonl
+# plays seeds 0 to 9999 on every core, writing one line per game.
+
+from core import batch
+
+import argparse
+import sys
+
+parser = argparse.ArgumentParser(description="Play games in bulk.")
+parser.add_argument("-n", "--games", type=int, default=100)
+parser.add_argument("-s", "--seed", type=int, default=0,
+                    help="the first seed; games use seed, seed+1, ...")
+parser.add_argument("-p", "--policy", default="hunter",
+                    choices=sorted(batch.POLICIES))
+parser.add_argument("-t", "--max-turns", type=int, default=1000)
+parser.add_argument("-j", "--processes", type=int, default=None)
+parser.add_argument("-o", "--output", default=None,
+                    help="a .jsonl or .csv file, or - for stdout")
+parser.add_argument("--store", action="store_true",
+                    help="keep entities in an EntityStore")
+parser.add_argument("--every", type=int, default=1000,
+                    help="print the totals every so many games")
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+
+    out = None
+    sink = None
+    if args.output == "-":
+        sink = batch.sink_for(sys.stdout)
+    elif args.output:
+        out = open(args.output, "w", newline="")
+        sink = batch.sink_for(out, args.output)
+
+    def progress(report, totals):
+        if args.every and totals.games % args.every == 0:
+            sys.stderr.write(totals.summary()[0]+"\n")
+
+    try:
+        totals = batch.run(range(args.seed, args.seed+args.games),
+                           args.policy, args.max_turns, args.processes,
+                           sink, progress, use_store=args.store)
+    finally:
+        if out: out.close()
+    sys.stderr.write("\n".join(totals.summary())+"\n")
@@ -0,0 +1,85 @@
+# Checks that the single-tile vision checks agree with the full field of vision
+# they stand in for, on random maps, for both FOV engines. Run from the top of
+# the repository with
+#   python -m unittest discover
+
+from core import world
+
+import random
+import unittest
+
+
+# A world using the given FOV engine, with 'walls' walls dropped at random.
+def random_world(rand, engine, walls):
+    w = world.World(seed=rand.randint(0,1000))
+    w.fov_engine = engine
+    for i in range(walls):
+        w.set_tile(rand.randint(0,39),rand.randint(0,39),"#")
+    return w
+
+def random_entity(rand):
+    e = world.Entity("robot",rand.randint(0,39),rand.randint(0,39))
+    e.angle = rand.choice([rand.uniform(0,360),rand.randint(0,5)*60,
+                           rand.uniform(-400,400)])
+    e.lense = rand.choice([rand.randint(0,100),0,30,180])
+    e.sight = rand.randint(1,12)
+    return e
+
+
+class TestFov(unittest.TestCase):
+    def check_can_see(self, engine):
+        rand = random.Random(engine)
+        for k in range(12):
+            w = random_world(rand, engine, rand.randint(0,400))
+            for j in range(15):
+                e = random_entity(rand)
+                view = w.fov(e.x,e.y,e.sight,
+                             [(e.angle-e.lense,e.angle+e.lense)])
+                for y in range(e.y-e.sight-1,e.y+e.sight+2):
+                    for x in range(e.x-e.sight-1,e.x+e.sight+2):
+                        self.assertEqual(w.can_see(e,(x,y)),(x,y) in view,
+                                         (engine,e.x,e.y,e.angle,e.lense,
+                                          e.sight,x,y))
+    
+    def test_can_see_arc(self):
+        self.check_can_see("arc")
+    
+    def test_can_see_shadow(self):
+        self.check_can_see("shadow")
+    
+    # in_cone may let through tiles that fov leaves out, but never the other
+    # way around.
+    def test_in_cone(self):
+        rand = random.Random(5)
+        for engine in ("arc","shadow"):
+            for k in range(8):
+                w = random_world(rand, engine, rand.randint(0,100))
+                for j in range(15):
+                    e = random_entity(rand)
+                    view = w.fov(e.x,e.y,e.sight,
+                                 [(e.angle-e.lense,e.angle+e.lense)])
+                    for (x,y) in view:
+                        self.assertTrue(world.in_cone(e.x,e.y,e.angle,e.lense,
+                                                      e.sight,x,y))
+    
+    def test_shadowcast_to(self):
+        rand = random.Random(2)
+        for k in range(12):
+            w = random_world(rand, "shadow", rand.randint(0,400))
+            opaque = w.map.is_opaque
+            for j in range(15):
+                x,y = rand.randint(0,39),rand.randint(0,39)
+                r = rand.randint(0,12)
+                angles = [(st,st+rand.uniform(0,400))
+                          for st in [rand.uniform(-400,400)
+                                     for i in range(rand.randint(1,2))]]
+                view = set(world.shadowcast(x,y,r,angles,opaque))
+                for ty in range(y-r-1,y+r+2):
+                    for tx in range(x-r-1,x+r+2):
+                        self.assertEqual(
+                            world.shadowcast_to((x,y),(tx,ty),r,angles,opaque),
+                            (tx,ty) in view, (x,y,r,angles,tx,ty))
+
+
+if __name__ == "__main__":
+    unittest.main()
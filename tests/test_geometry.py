@@ -0,0 +1,179 @@
+# Checks the hex geometry in core.world against the original versions, which
+# built whole rings and walked them. Those are copied here as they were, so
+# that any later rewrite of the fast versions has to give exactly the same
+# tiles. Run from the top of the repository with
+#   python -m unittest discover
+
+from core import world
+
+import random
+import unittest
+
+
+# The original ring walk. The 0-degree tile is at the beginning and end of
+# the list.
+def old_ring(x,y,r):
+    report = []
+    odd = True if y % 2 == 1 else False
+    
+    x += r
+    report.append((x,y))
+    for i in range(r): #going up-left
+        if not odd: x -= 1
+        y -= 1
+        report.append((x,y))
+        odd = not odd
+    for i in range(r): #going left
+        x -= 1
+        report.append((x,y))
+    for i in range(r): #going down-left
+        if not odd: x -= 1
+        y += 1
+        report.append((x,y))
+        odd = not odd
+    for i in range(r): #going down-right
+        if odd: x += 1
+        y += 1
+        report.append((x,y))
+        odd = not odd
+    for i in range(r): #going right
+        x += 1
+        report.append((x,y))
+    for i in range(r): #going up-right
+        if odd: x += 1
+        y -= 1
+        report.append((x,y))
+        odd = not odd
+    return report
+
+def old_arc(x, y, r, endpoints):
+    if r < 1:
+        return [(x,y)]
+    orig = old_ring(x,y,r)
+    report = []
+    for (st, en) in endpoints:
+        chunk_size = 360.0 / (r*6)
+        h_chunk = chunk_size / 2
+        while st < 0:
+            st += 360
+            en += 360
+        if en-st > 359:
+            return orig
+        if st < en:
+            st_i = int(1.0*(st+h_chunk) / chunk_size) % (r*6)
+            en_i = int(1.0*(en+h_chunk) / chunk_size) % (r*6)
+            if st_i <= en_i:
+                report += orig[st_i:en_i+1]
+            else:
+                report += orig[st_i:]
+                report += orig[:en_i+1]
+    return report
+
+def old_distance( pos1, pos2 ):
+    x1,y1 = pos1
+    x2,y2 = pos2
+    if x1 > x2:
+        x1,y1 = pos2
+        x2,y2 = pos1
+    
+    dist = 0
+    odd = True if y2 % 2 == 1 else False
+    dy = 1 if y1 > y2 else -1
+    while y1 != y2:
+        if x1 < x2:
+            if not odd: x2 -= 1
+        y2 += dy
+        odd = not odd
+        dist += 1
+    dist += x2-x1
+    return dist
+
+def old_angle( pos1, pos2 ):
+    if pos1 == pos2:
+        return None
+    x1,y1 = pos1
+    r = old_distance(pos1,pos2)
+    i = old_ring(x1,y1,r).index(pos2)
+    return i * 360.0 / (r*6)
+
+def old_apoint(x,y,r,theta):
+    if r == 0:
+        return (x,y)
+    theta = theta%360
+    orig = old_ring(x,y,r)
+    chunk_size = 360.0 / (r*6)
+    h_chunk = chunk_size / 2
+    i = int(1.0*(theta+h_chunk) / chunk_size) % (r*6)
+    return orig[i]
+
+def old_aline(x,y,r,theta):
+    return [old_apoint(x,y,i,theta) for i in range(1,r+1)]
+
+def old_direction(x, y, d):
+    if d < 0 or d > 5: return None
+    else: return old_ring(x,y,1)[d]
+
+
+# Every position within RADIUS of a few centers, on both row parities.
+RADIUS = 12
+CENTERS = [(0,0),(3,1),(-2,-1),(5,-4)]
+
+def around():
+    for (ox,oy) in CENTERS:
+        for y in range(oy-RADIUS,oy+RADIUS+1):
+            for x in range(ox-RADIUS,ox+RADIUS+1):
+                yield (ox,oy),(x,y)
+
+
+class TestGeometry(unittest.TestCase):
+    def test_ring(self):
+        for r in range(0,40):
+            for y in range(-3,4):
+                self.assertEqual(world.ring(5,y,r), old_ring(5,y,r))
+    
+    def test_distance(self):
+        for a,b in around():
+            self.assertEqual(world.distance(a,b), old_distance(a,b))
+    
+    def test_angle(self):
+        for a,b in around():
+            self.assertEqual(world.angle(a,b), old_angle(a,b))
+    
+    def test_direction(self):
+        for a,(x,y) in around():
+            for d in range(-1,7):
+                self.assertEqual(world.direction(x,y,d),old_direction(x,y,d))
+    
+    # apoint and aline at every tile center and edge of every ring, and at
+    # random angles in between, including negative ones and ones past 360.
+    def test_apoint(self):
+        rand = random.Random(3)
+        for (x,y) in CENTERS:
+            for r in range(0,RADIUS+1):
+                n = 6*r or 1
+                thetas = [i*360.0/n + k*180.0/n
+                          for i in range(-n,2*n+1) for k in (-1,0,1)]
+                thetas += [rand.uniform(-720,720) for i in range(50)]
+                for t in thetas:
+                    self.assertEqual(world.apoint(x,y,r,t),
+                                     old_apoint(x,y,r,t))
+                    self.assertEqual(world.aline(x,y,r,t),
+                                     old_aline(x,y,r,t))
+    
+    def test_arc(self):
+        rand = random.Random(1)
+        for k in range(5000):
+            x,y = rand.randint(-20,20),rand.randint(-20,20)
+            r = rand.randint(0,15)
+            ends = []
+            for j in range(rand.randint(1,3)):
+                st = rand.uniform(-400,400)
+                en = st+rand.choice([rand.uniform(-10,370),
+                                     rand.uniform(0,60)])
+                if rand.random() < 0.2: st,en = float(int(st)),float(int(en))
+                ends.append((st,en))
+            self.assertEqual(world.arc(x,y,r,ends), old_arc(x,y,r,ends))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,73 @@
+# Checks that EntityStore.perceive gives the same answer with NumPy columns as
+# with plain arrays, and that both agree with in_cone. The NumPy half is
+# skipped if NumPy isn't installed. Run from the top of the repository with
+#   python -m unittest discover
+
+from core import world
+
+import random
+import unittest
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# Fill a store with 'n' random entities, some of them dead and some removed
+# again, so that there are free slots and the store has had to grow.
+def random_store(rand, use_numpy, n=150):
+    store = world.EntityStore(capacity=8, use_numpy=use_numpy)
+    ents = []
+    for i in range(n):
+        e = world.StoredEntity(store,"robot",rand.randint(0,39),
+                               rand.randint(0,39))
+        e.angle = rand.choice([rand.uniform(0,360),rand.randint(0,5)*60,
+                               rand.uniform(-400,400)])
+        e.lense = rand.choice([rand.randint(0,100),0,30,180])
+        e.sight = rand.randint(0,12)
+        e.hp = rand.choice([5,5,5,0,-1])
+        ents.append(e)
+    for e in rand.sample(ents, n//5):
+        store.remove(e.i)
+        ents.remove(e)
+    return store, ents
+
+# The slots perceive finds for (x,y).
+def perceived(store, x, y):
+    return sorted(e.i for e in store.perceive(x,y))
+
+
+class TestStore(unittest.TestCase):
+    def check_in_cone(self, use_numpy):
+        rand = random.Random(4)
+        for k in range(10):
+            store,ents = random_store(rand, use_numpy)
+            for j in range(40):
+                x,y = rand.randint(-5,44),rand.randint(-5,44)
+                want = sorted(e.i for e in ents if e.hp > 0 and
+                              world.in_cone(e.x,e.y,e.angle,e.lense,e.sight,
+                                            x,y))
+                self.assertEqual(perceived(store,x,y), want)
+    
+    def test_arrays(self):
+        self.check_in_cone(False)
+    
+    @unittest.skipIf(numpy is None, "NumPy isn't installed")
+    def test_numpy(self):
+        self.check_in_cone(True)
+    
+    # The same entities in both kinds of store are seen by the same slots.
+    @unittest.skipIf(numpy is None, "NumPy isn't installed")
+    def test_numpy_matches_arrays(self):
+        for seed in range(10):
+            plain = random_store(random.Random(seed), False)[0]
+            fast = random_store(random.Random(seed), True)[0]
+            rand = random.Random(seed)
+            for j in range(40):
+                x,y = rand.randint(-5,44),rand.randint(-5,44)
+                self.assertEqual(perceived(fast,x,y), perceived(plain,x,y))
+
+
+if __name__ == "__main__":
+    unittest.main()
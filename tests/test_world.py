@@ -0,0 +1,46 @@
+# Checks that a seeded World plays out the same whatever it's asked to do per
+# step. Run from the top of the repository with
+#   python -m unittest discover
+
+from core import world
+
+import random
+import unittest
+
+
+KEYS = "kiuhnmfrescxz"
+
+# Everything about a world that the game depends on.
+def state(w):
+    ents = [(e.name,e.x,e.y,e.hp,e.init,e.angle,e.target) for e in w.entities]
+    return (ents, sorted(w.stats.items()), w.difficulty, w.round,
+            w.player.target, w.random_state())
+
+# Play a game from 'seed', feeding the same keys on the same steps, with the
+# given turn budget, on a level crowded enough that the budget runs out. Once
+# the keys run out, step until the world is waiting on the player again, so
+# that a world that fell behind can catch up.
+def play(seed, budget, steps=600):
+    keys = random.Random(seed)
+    w = world.World(seed=seed)
+    w.turn_budget = budget
+    w.new_world(3)
+    for i in range(steps):
+        w.step(keys.choice(KEYS) if keys.random() < 0.5 else ())
+    for i in range(5000):
+        if w.idle() or not w.running:
+            break
+        w.step(())
+    return state(w)
+
+
+class TestTurnBudget(unittest.TestCase):
+    def test_budget_keeps_game(self):
+        for seed in range(6):
+            unlimited = play(seed, None)
+            for budget in (1, 3, 64):
+                self.assertEqual(play(seed, budget), unlimited)
+
+
+if __name__ == "__main__":
+    unittest.main()